@@ -0,0 +1,297 @@
+import collections
+import fractions
+import math
+import threading
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """
+    Fixed capacity, array backed ring buffer of audio samples.
+    Frames are copied in place, when the buffer is full the oldest samples get overwritten.
+    """
+
+    def __init__(self, capacity, dtype=np.int16):
+        self.capacity = max(int(capacity), 1)
+        self.data = np.zeros(self.capacity, dtype=dtype)
+        self.head = 0       # position the next sample will be written to
+        self.length = 0     # number of valid samples, ends right before head
+
+    def __len__(self):
+        return self.length
+
+    def clear(self):
+        self.head = 0
+        self.length = 0
+
+    def resize(self, capacity):
+        # keep the most recent samples which still fit into the new capacity
+        samples = self.read()
+        self.capacity = max(int(capacity), 1)
+        self.data = np.zeros(self.capacity, dtype=self.data.dtype)
+        self.clear()
+        self.write(samples)
+
+    def write(self, frame):
+        n = len(frame)
+        if n >= self.capacity:
+            # frame alone fills the whole buffer, only keep the tail of it
+            self.data[:] = frame[n - self.capacity:]
+            self.head = 0
+            self.length = self.capacity
+            return
+
+        end = self.head + n
+        if end <= self.capacity:
+            self.data[self.head:end] = frame
+        else:
+            first = self.capacity - self.head
+            self.data[self.head:] = frame[:first]
+            self.data[:n - first] = frame[first:]
+
+        self.head = end % self.capacity
+        self.length = min(self.length + n, self.capacity)
+
+    def keep_last(self, n):
+        # drop everything but the last n samples, no data is moved
+        self.length = min(self.length, max(int(n), 0))
+
+    def read(self, n=None):
+        """Returns a contiguous copy of the last n samples (all samples by default)"""
+        if n is None or n > self.length:
+            n = self.length
+
+        start = self.head - n
+        if start >= 0:
+            return self.data[start:self.head].copy()
+
+        out = np.empty(n, dtype=self.data.dtype)
+        out[:-start] = self.data[start:]
+        out[-start:] = self.data[:self.head]
+        return out
+
+
+class FrameQueue(object):
+    """
+    Single producer, single consumer queue of interleaved audio frames copied into preallocated slots.
+    No lock is taken: tail is only advanced by the producer, head only by the consumer,
+    and a slot isn't written again before the consumer released it.
+    When the consumer falls behind and every slot is taken, new frames are dropped and counted.
+    """
+
+    def __init__(self, slots=32, slot_size=8192 * 4):
+        self.slots = [np.zeros(slot_size, dtype=np.int16) for _ in range(max(slots, 1))]
+        self.frames = [None] * len(self.slots)  # (samples, channels, timestamp) of each slot
+        self.head = 0       # count of frames consumed
+        self.tail = 0       # count of frames queued
+        self.ready = threading.Event()
+
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def put(self, buffer, channels, timestamp):
+        """Copies a frame from ALAudioDevice into the queue, returns False if it was dropped"""
+        self.received += 1
+        depth = self.tail - self.head
+        if depth >= len(self.slots):
+            self.dropped += 1
+            return False
+
+        index = self.tail % len(self.slots)
+        samples = np.frombuffer(buffer, dtype='<i2')
+        if len(samples) > len(self.slots[index]):
+            self.slots[index] = np.zeros(len(samples), dtype=np.int16)
+        slot = self.slots[index][:len(samples)]
+        slot[:] = samples
+        self.frames[index] = (slot, channels, timestamp)
+
+        self.tail += 1
+        self.high_water = max(self.high_water, depth + 1)
+        self.ready.set()
+        return True
+
+    def peek(self, timeout=None):
+        """
+        Waits for the oldest frame, returns (samples, channels, timestamp) or None when woken up or timed out.
+        Its samples are valid until release(). On python 2 waiting with a timeout polls, so wait without one.
+        """
+        self.ready.clear()
+        if self.tail == self.head:
+            self.ready.wait(timeout)
+            if self.tail == self.head:
+                return None
+        return self.frames[self.head % len(self.slots)]
+
+    def release(self):
+        self.head += 1
+
+    def wake(self):
+        """Makes a waiting peek() return, e.g. to stop the consumer"""
+        self.ready.set()
+
+    def stats(self):
+        return {
+            'depth': len(self),
+            'high_water': self.high_water,
+            'received': self.received,
+            'dropped': self.dropped
+        }
+
+
+def frame_samples(buffer, nbOfChannels, channel=0):
+    """Zero copy view of one channel of an interleaved 16 bits little endian buffer from ALAudioDevice"""
+    samples = np.frombuffer(buffer, dtype='<i2')
+    return samples[channel::nbOfChannels]
+
+
+def quietest_point(samples, window):
+    """Index of the middle of the lowest energy window of samples, splitting there cuts the least speech"""
+    count = len(samples) // window
+    if count < 1:
+        return len(samples) // 2
+    frames = samples[:count * window].astype(np.float64).reshape(count, window)
+    return int(np.argmin((frames * frames).sum(axis=1))) * window + window // 2
+
+
+class FrameAnalyzer(object):
+    """
+    Computes the energy of audio frames without allocating per frame.
+    After analyze(), rms and peak are normalized to 0.0 ... 1.0, dbfs is relative to full scale.
+    level is the value compared against the auto detection threshold, it keeps the scale of
+    the old convertStr2SignedInt/calcRMSLevel (roughly rms of int16 samples / 128)
+    so existing AUTO_DETECTION_THREADSHOLD values still work.
+    """
+
+    LEVEL_SCALE = 128.0
+    MIN_DBFS = -120.0
+
+    def __init__(self, max_samples=8192):
+        self.scratch = np.zeros(max_samples, dtype=np.float64)
+
+        self.rms = 0.0
+        self.peak = 0.0
+        self.dbfs = self.MIN_DBFS
+        self.level = 0.0
+
+    def analyze(self, samples):
+        n = len(samples)
+        if n == 0:
+            return self.level
+
+        if n > len(self.scratch):
+            self.scratch = np.zeros(n, dtype=np.float64)
+
+        # cast int16 into the reused scratch buffer, dot product does the squaring and sum in place
+        data = self.scratch[:n]
+        np.copyto(data, samples, casting='unsafe')
+
+        rms = math.sqrt(np.dot(data, data) / n)
+        peak = max(data.max(), -data.min())
+
+        self.rms = rms / 32768.0
+        self.peak = peak / 32768.0
+        self.dbfs = 20 * math.log10(self.rms) if self.rms > 0 else self.MIN_DBFS
+        self.level = rms / self.LEVEL_SCALE
+
+        return self.level
+
+
+class NoiseFloor(object):
+    """
+    Online estimate of the background level: a low percentile of the levels of the last window seconds,
+    smoothed with an exponential moving average of time_constant seconds.
+    The percentile ignores speech and short loud sounds, the average keeps the estimate from jumping.
+    Nothing is estimated before a whole window was seen.
+    """
+
+    def __init__(self, window=4.0, percentile=20, time_constant=10.0):
+        self.window = window
+        self.percentile = percentile
+        self.time_constant = time_constant
+        self.reset()
+
+    def reset(self):
+        self.levels = collections.deque()   # (level, duration)
+        self.duration = 0.0
+        self.floor = None
+
+    def calibrated(self):
+        return self.floor is not None
+
+    def update(self, level, duration):
+        self.levels.append((level, duration))
+        self.duration += duration
+        while self.duration - self.levels[0][1] >= self.window:
+            self.duration -= self.levels.popleft()[1]
+
+        if self.duration < self.window:
+            return
+
+        estimate = np.percentile([l for l, _ in self.levels], self.percentile)
+        if self.floor is None:
+            self.floor = estimate
+        else:
+            alpha = 1 - math.exp(-duration / self.time_constant)
+            self.floor += alpha * (estimate - self.floor)
+
+
+class Resampler(object):
+    """
+    Polyphase rational resampler, e.g. 48kHz -> 16kHz.
+    Filter state is kept between calls to process(), so audio can also be resampled chunk by chunk.
+    """
+
+    def __init__(self, in_rate, out_rate, taps_per_phase=64, beta=7.0):
+        g = fractions.gcd(in_rate, out_rate)
+        self.up = out_rate // g
+        self.down = in_rate // g
+        self.taps = taps_per_phase
+
+        # windowed sinc low pass at the upsampled rate, cut off a bit below the lower of both nyquist frequencies
+        # so the transition band ends close to it: for 48kHz -> 16kHz it's -6dB at 7.2kHz and below -70dB from 9kHz,
+        # nothing that would fold back below 7kHz gets through
+        n = self.up * taps_per_phase
+        cutoff = 0.45 / max(self.up, self.down)
+        i = np.arange(n) - (n - 1) / 2.0
+        h = 2 * cutoff * np.sinc(2 * cutoff * i) * np.kaiser(n, beta) * self.up
+
+        # phases[p, k] = h[p + k * up], the taps applied to outputs with upsampled position % up == p
+        self.phases = h.reshape(taps_per_phase, self.up).T.copy()
+
+        self.history = np.zeros(taps_per_phase - 1)
+        self.position = 0   # upsampled position of the next output, relative to the next chunk
+
+    def process(self, samples):
+        x = np.concatenate((self.history, np.asarray(samples, dtype=np.float64)))
+        up, down, taps = self.up, self.down, self.taps
+
+        end = len(samples) * up
+        count = max((end - self.position + down - 1) // down, 0)
+        out = np.zeros(count)
+
+        # every up-th output uses the same phase, their inputs are spaced down samples apart
+        # so each phase/tap pair is a single strided multiply-add over the whole chunk
+        for j in range(min(up, count)):
+            position = self.position + j * down
+            phase = position % up
+            newest = position // up + taps - 1
+            n = len(range(j, count, up))
+            for k in range(taps):
+                start = newest - k
+                out[j::up] += self.phases[phase, k] * x[start:start + (n - 1) * down + 1:down]
+
+        self.position += count * down - end
+        self.history = x[len(x) - (taps - 1):]
+
+        return np.clip(np.round(out), -32768, 32767).astype(np.int16)
+
+
+def resample(samples, in_rate, out_rate):
+    if in_rate == out_rate:
+        return samples
+    return Resampler(in_rate, out_rate).process(samples)
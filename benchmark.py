@@ -0,0 +1,450 @@
+import collections
+import time
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+
+import numpy as np
+from optparse import OptionParser
+
+from audio import FrameAnalyzer, frame_samples
+from cache import SimilarityIndex, ngram_features
+from stubs import PROFILES, start_process
+
+SAMPLE_RATE = 48000
+CHANNELS = 4
+SAMPLES_PER_FRAME = 8192    # ALAudioDevice delivers ~170ms per callback at 48kHz
+
+
+def make_frames(count, amplitude=2000, seed=0):
+    rng = np.random.RandomState(seed)
+    frames = []
+    for _ in range(count):
+        data = rng.normal(0, amplitude, CHANNELS * SAMPLES_PER_FRAME)
+        frames.append(np.clip(data, -32768, 32767).astype('<i2').tobytes())
+    return frames
+
+# the frame path before FrameAnalyzer, kept here to compare against
+def legacy_convert(data):
+    lsb = data[0::2]
+    msb = data[1::2]
+    rms_data = np.add(lsb, np.multiply(msb, 256.0))
+    sign_correction = np.select([rms_data>=32768], [-65536])
+    rms_data = np.add(rms_data, sign_correction)
+    return np.divide(rms_data, 32768.0)
+
+def legacy_analyze(buffer):
+    interlaced = np.fromstring(str(buffer), dtype=np.int16)
+    sound_data = np.reshape(interlaced, (CHANNELS, SAMPLES_PER_FRAME), 'F')
+    return np.sqrt(np.mean(np.square(legacy_convert(sound_data[0]))))
+
+def analyze(buffer, analyzer):
+    return analyzer.analyze(frame_samples(buffer, CHANNELS))
+
+def run(fn, frames, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for frame in frames:
+            fn(frame)
+    elapsed = time.time() - start
+    return len(frames) * repeat / elapsed
+
+def bench_frames(frame_count=50, repeat=20):
+    frames = make_frames(frame_count)
+    analyzer = FrameAnalyzer(SAMPLES_PER_FRAME)
+
+    legacy_fps = run(legacy_analyze, frames, repeat)
+    fps = run(lambda f: analyze(f, analyzer), frames, repeat)
+
+    return {
+        'suite': 'frames',
+        'samples_per_frame': SAMPLES_PER_FRAME,
+        'channels': CHANNELS,
+        'legacy_frames_per_second': round(legacy_fps, 1),
+        'frames_per_second': round(fps, 1),
+        'speedup': round(fps / legacy_fps, 2),
+        'realtime_factor': round(fps * SAMPLES_PER_FRAME / float(SAMPLE_RATE), 1)
+    }
+
+# visitor questions at a venue, slots are filled with words of these lists
+QUESTION_TEMPLATES = (
+    'where is the {place}', 'how do i get to the {place}', 'is there a {place} on the {floor} floor',
+    'is the {place} open {day}', 'what are the opening hours of the {place} {day}',
+    'what time does the {topic} {event} start {day}', 'when does the {topic} {event} end',
+    'where is the {topic} {event} taking place', 'who is speaking at the {topic} {event}',
+    'can you tell me something about {topic}', 'what do you know about {topic}', 'is there a {event} about {topic} {day}',
+    'how much does a {item} cost', 'where can i buy a {item}', 'do you have a {item} for me',
+    'who is {first} {last}', 'where can i find {first} {last}', 'when is {first} {last} giving a talk',
+    'is {first} {last} at the {topic} {event}', 'i am looking for {first} {last} from the {place}',
+)
+QUESTION_SLOTS = {
+    'place': (
+        'toilet', 'exit', 'main entrance', 'cafeteria', 'coffee bar', 'restaurant', 'cloakroom', 'reception',
+        'information desk', 'elevator', 'staircase', 'parking garage', 'bus stop', 'train station', 'taxi stand',
+        'first aid room', 'prayer room', 'lost and found', 'ticket office', 'gift shop', 'book store', 'pharmacy',
+        'auditorium', 'main hall', 'exhibition hall', 'press room', 'wardrobe', 'smoking area', 'playground',
+        'charging station', 'atm', 'library', 'lecture room', 'workshop room', 'lounge', 'terrace', 'garden',
+        'museum shop', 'baby changing room', 'meeting point'
+    ),
+    'floor': ('ground', 'first', 'second', 'third', 'fourth', 'top'),
+    'day': ('today', 'tomorrow', 'on monday', 'on tuesday', 'on wednesday', 'on thursday', 'on friday',
+            'on saturday', 'on sunday', 'in the evening', 'at night', 'this weekend'),
+    'topic': (
+        'robotics', 'machine learning', 'climate change', 'renewable energy', 'space travel', 'quantum computing',
+        'healthcare', 'nutrition', 'modern art', 'photography', 'architecture', 'urban planning', 'mobility',
+        'electric cars', 'blockchain', 'cyber security', 'privacy', 'education', 'startups', 'marketing',
+        'design thinking', 'music production', 'film making', 'game development', 'virtual reality', 'biology',
+        'genetics', 'neuroscience', 'psychology', 'philosophy', 'history', 'astronomy', 'ocean research',
+        'agriculture', 'food waste', 'recycling', 'water supply', 'smart homes', 'drones', 'open source',
+        'social media', 'journalism', 'literature', 'poetry', 'dance', 'theatre', 'fashion', 'sports',
+        'football', 'cycling', 'chess', 'mathematics', 'physics', 'chemistry', 'medicine', 'nursing',
+        'elder care', 'accessibility', 'languages', 'tourism'
+    ),
+    'event': ('talk', 'workshop', 'keynote', 'panel', 'tour', 'meetup', 'lecture', 'demo', 'exhibition', 'concert'),
+    'item': (
+        'ticket', 'day pass', 'weekend pass', 'coffee', 'tea', 'sandwich', 'bottle of water', 'umbrella', 'map',
+        'program booklet', 'badge', 'lanyard', 't shirt', 'poster', 'postcard', 'charging cable', 'power bank',
+        'locker', 'audio guide', 'parking ticket'
+    ),
+    'first': (
+        'anna', 'ben', 'carla', 'david', 'emma', 'felix', 'greta', 'hans', 'ida', 'jonas', 'klara', 'lukas',
+        'marie', 'noah', 'olivia', 'paul', 'rosa', 'simon', 'tina', 'victor', 'wiebke', 'yusuf', 'zoe', 'ahmed',
+        'bianca', 'chen', 'dmitri', 'elena', 'farid', 'hiro'
+    ),
+    'last': (
+        'schmidt', 'meyer', 'weber', 'fischer', 'wagner', 'becker', 'hoffmann', 'koch', 'richter', 'klein',
+        'wolf', 'neumann', 'schwarz', 'braun', 'zimmermann', 'hartmann', 'lange', 'krause', 'lehmann', 'kaya',
+        'nguyen', 'rossi', 'garcia', 'novak', 'jansen', 'silva', 'tanaka', 'kowalski', 'dubois', 'larsen'
+    ),
+}
+
+# ways speech recognition and people word the same question differently
+QUESTION_PREFIXES = ('', '', '', 'excuse me ', 'hello ', 'um ', 'sorry ', 'hi robot ')
+QUESTION_SUFFIXES = ('', '', '', ' please', ' thanks', ' right now')
+
+def make_questions(count, seed=0):
+    """Returns count distinct questions made from the templates"""
+    rng = np.random.RandomState(seed)
+    questions = collections.OrderedDict()
+    while len(questions) < count:
+        template = QUESTION_TEMPLATES[rng.randint(len(QUESTION_TEMPLATES))]
+        slots = dict((name, words[rng.randint(len(words))]) for name, words in QUESTION_SLOTS.items())
+        questions[template.format(**slots)] = True
+    return list(questions)
+
+def reword(question, rng):
+    """The question as somebody else might ask it, with a filler, a dropped word or a misrecognized letter"""
+    words = question.split()
+    change = rng.randint(3)
+    if change == 0 and len(words) > 3:
+        del words[rng.randint(len(words))]
+    elif change == 1:
+        word = rng.randint(len(words))
+        if len(words[word]) > 3:
+            letter = rng.randint(1, len(words[word]))
+            words[word] = words[word][:letter] + 'aeiou'[rng.randint(5)] + words[word][letter + 1:]
+    question = ' '.join(words)
+    return QUESTION_PREFIXES[rng.randint(len(QUESTION_PREFIXES))] + question + QUESTION_SUFFIXES[rng.randint(len(QUESTION_SUFFIXES))]
+
+def exact_match(index, question):
+    """Best entry above threshold of a scan scoring every entry of a rebuilt index, to check the index against"""
+    features, tf = ngram_features(question)
+    weights = index.weights(features, tf)
+    positions = np.minimum(np.searchsorted(features, index.rows_features), len(features) - 1)
+    products = np.where(features[positions] == index.rows_features, weights[positions], 0) * index.rows_weights
+    scores = np.bincount(np.repeat(np.arange(index.compiled), np.diff(index.rows_indptr)), weights=products)
+    best = int(scores.argmax())
+    return index.answers[best] if scores[best] >= index.threshold else None
+
+def bench_similarity(entries=20000, queries=400, checked=100):
+    """
+    Half of the queries are indexed questions reworded, half are new ones,
+    the first checked of them are compared with a scan scoring every entry.
+    """
+    index = SimilarityIndex(threshold=0.8)
+    indexed = make_questions(entries)
+
+    start = time.time()
+    for i, question in enumerate(indexed):
+        index.add(question, 'answer %d' % i, rebuild=False)
+    index.rebuild()
+    build = time.time() - start
+
+    rng = np.random.RandomState(1)
+    questions = [reword(indexed[i], rng) for i in rng.randint(0, entries, queries // 2)]
+    questions += make_questions(queries - len(questions), seed=1)
+    rng.shuffle(questions)
+
+    times, matches = [], []
+    for question in questions:
+        start = time.time()
+        match = index.query(question)
+        times.append(time.time() - start)
+        matches.append(match[0] if match else None)
+    agree = sum(1 for question, match in zip(questions[:checked], matches) if exact_match(index, question) == match)
+
+    return {
+        'suite': 'similarity',
+        'entries': entries,
+        'build_seconds': round(build, 3),
+        'query_ms': round(np.mean(times) * 1000, 3),
+        'query_ms_p99': round(np.percentile(times, 99) * 1000, 3),
+        'query_ms_max': round(max(times) * 1000, 3),
+        'hit_rate': round(sum(1 for match in matches if match) / float(queries), 3),
+        'exact_agreement': round(agree / float(min(checked, queries)), 3)
+    }
+
+def make_utterances(count, rate=SAMPLE_RATE, seed=0):
+    """Yields replay utterances of 1-3s noise with a syllable like envelope, after a short silence"""
+    rng = np.random.RandomState(seed)
+    for i in range(count):
+        duration = rng.uniform(1.0, 3.0)
+        t = np.arange(int(duration * rate)) / float(rate)
+        envelope = 0.3 + 0.7 * np.abs(np.sin(2 * np.pi * 2.5 * t))
+        speech = rng.normal(0, 3000, len(t)) * envelope
+        samples = np.concatenate((np.zeros(int(0.3 * rate)), speech))
+        yield 'utterance %d' % i, np.clip(samples, -32768, 32767).astype(np.int16), rate, None
+
+def bench_e2e(turns=10, profile='cloud', speed=4.0, capture_profile='all-48k', stream=False):
+    """
+    Replays synthetic utterances through speech recognition and the receiver against stub services
+    running in a child process, so cpu time and memory are the pipeline's (and the replay's) only.
+    """
+    import replay
+    if not replay.fake:
+        replay.install()
+
+    from module_speechrecognition import SpeechRecognitionModule
+    from module_receiver import BaseSpeechReceiverModule
+    from module_eyecontact import EyeContactModule
+    from metrics import metrics
+    from tools import http_pool
+
+    process, url = start_process(profile=profile, seed=0, default_transcript='where is the toilet')
+
+    # modules print every recognition and response, keep the output json only
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        speech = SpeechRecognitionModule('SpeechRecognition', None, None, url)
+        speech.setCaptureProfile(capture_profile)
+        speech.setHoldTime(2.0)
+        speech.setIdleReleaseTime(1.0)
+        speech.setMaxRecordingDuration(7.0)
+        speech.setLookaheadDuration(0.5)
+        speech.setAutoDetectionThreshold(5)
+        speech.enableAutoDetection()
+        speech.start()
+
+        receiver = BaseSpeechReceiverModule(
+            'Receiver', None, None,
+            server_url=url, base_route='/chat/completions', api_key=None, model_name=None,
+            stream=stream
+        )
+        receiver.start()
+
+        # turns face detection of the replay into eye contact
+        EyeContactModule('EyeContact')
+
+        replayer = replay.Replay(speech, speed=speed)
+        report = replayer.run(make_utterances(turns))
+
+        speech.stop()
+        receiver.stop()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        http_pool.clear()
+        process.terminate()
+
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+    summary = metrics.summary()
+    rate = speech.sampleRate
+
+    return {
+        'suite': 'e2e',
+        'profile': profile,
+        'speed': speed,
+        'capture_profile': capture_profile,
+        'stream': stream,
+        'turns': turns,
+        'audio_seconds': report['audio_seconds'],
+        'wall_seconds': report['wall_seconds'],
+        'frames_per_second': report['frames_per_second'],
+        'frames_dropped': report['frames_dropped'],
+        'frame_queue_high_water': report['frame_queue_high_water'],
+        'realtime_factor': round(report['frames_per_second'] * replayer.frame_size(rate) / float(rate), 1),
+        'cpu_seconds_per_audio_second': round(cpu / report['audio_seconds'], 4),
+        'peak_rss_mb': round(after.ru_maxrss / 1024.0, 1),     # kilobytes on linux
+        'latency': dict((span, dict((q, round(v, 4)) for q, v in values.items())) for span, values in summary['latency'].items()),
+        'counters': summary['counters']
+    }
+
+def percentiles(values):
+    if not values:
+        return {}
+    return dict(('p%d' % q, round(float(v), 4)) for q, v in zip((50, 95, 99), np.percentile(values, [50, 95, 99])))
+
+def bench_gateway(robots=12, rounds=3, profile='cloud'):
+    """
+    A fleet of robots talking at the same time through the gateway to stub services in a child process.
+    Every round each robot uploads a recording and asks the same question, like a group of visitors at an event.
+    """
+    from gateway import Gateway
+    from tools import request, buffer_to_wav_in_memory, http_pool
+
+    batch_route = '/speech/recognition/batch'
+    process, url = start_process(profile=profile, seed=0, batch_route=batch_route)
+    gateway = Gateway(url, '127.0.0.1', 0, batch_route=batch_route, global_limit=robots, robot_limit=2).start()
+
+    wav = buffer_to_wav_in_memory(np.zeros(16000, dtype=np.int16), sample_rate=16000)
+    latencies = {'stt': [], 'chat': []}
+    lock = threading.Lock()
+
+    def robot(i):
+        headers = {'X-Robot-Id': 'robot-%d' % i}
+        for n in range(rounds):
+            start = time.time()
+            request(gateway.url, '/speech/recognition', wav, dict(headers, **{'Content-Type': 'audio/wav'}), is_json=False)
+            recognized = time.time()
+            request(gateway.url, '/chat/completions', {'messages': [{'role': 'user', 'content': 'question %d' % n}]}, headers)
+            with lock:
+                latencies['stt'].append(recognized - start)
+                latencies['chat'].append(time.time() - recognized)
+
+    start = time.time()
+    try:
+        threads = [threading.Thread(target=robot, args=(i,)) for i in range(robots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = gateway.stats()
+    finally:
+        gateway.stop()
+        http_pool.clear()
+        process.terminate()
+
+    requests = stats['requests']
+    return {
+        'suite': 'gateway',
+        'profile': profile,
+        'robots': robots,
+        'rounds': rounds,
+        'wall_seconds': round(time.time() - start, 3),
+        'robot_requests': requests.get('speech', 0) + requests.get('chat', 0),
+        'upstream_requests': requests.get('upstream', 0),
+        'deduplicated': requests.get('deduplicated', 0),
+        'upstream_errors': requests.get('upstream_errors', 0),
+        'average_batch': round(stats['batches']['average_batch'], 2),
+        'rejected': stats['limits']['rejected'],
+        'latency': dict((kind, percentiles(values)) for kind, values in latencies.items())
+    }
+
+SUITES = {
+    'e2e': lambda opts: bench_e2e(opts.turns, opts.profile, opts.speed, opts.capture_profile, opts.stream),
+    'gateway': lambda opts: bench_gateway(opts.robots, opts.rounds, opts.profile),
+    'frames': lambda opts: bench_frames(opts.frames, opts.repeat),
+    'similarity': lambda opts: bench_similarity(opts.entries)
+}
+
+def environment():
+    # to tell apart results of different commits and machines
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'time': time.time(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform()
+    }
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--frames",
+        help="Number of distinct frames to generate, default 50",
+        dest="frames",
+        type="int")
+    parser.add_option("--repeat",
+        help="How many times each frame is processed, default 20",
+        dest="repeat",
+        type="int")
+    parser.add_option("--entries",
+        help="Number of questions in the similarity index, default 20000",
+        dest="entries",
+        type="int")
+    parser.add_option("--turns",
+        help="Number of utterances replayed end to end, default 10",
+        dest="turns",
+        type="int")
+    parser.add_option("--robots",
+        help="Number of robots talking through the gateway at the same time, default 12",
+        dest="robots",
+        type="int")
+    parser.add_option("--rounds",
+        help="Questions each robot asks through the gateway, default 3",
+        dest="rounds",
+        type="int")
+    parser.add_option("--profile",
+        help="Latency profile of the stub services: " + ', '.join(sorted(PROFILES)) + ", default cloud",
+        dest="profile")
+    parser.add_option("--speed",
+        help="Replay audio this many times faster than real time, default 4",
+        dest="speed",
+        type="float")
+    parser.add_option("--capture-profile",
+        help="Capture profile of speech recognition, default all-48k",
+        dest="capture_profile")
+    parser.add_option("--stream",
+        help="Stream chat completions in the end to end suite",
+        dest="stream",
+        action='store_true')
+    parser.add_option("--suite",
+        help="Run only this suite: " + ', '.join(sorted(SUITES)),
+        dest="suite")
+    parser.add_option("--output",
+        help="Also write the results to this json file",
+        dest="output")
+    parser.set_defaults(
+        frames=50,
+        repeat=20,
+        entries=20000,
+        turns=10,
+        robots=12,
+        rounds=3,
+        profile='cloud',
+        speed=4.0,
+        capture_profile='all-48k',
+        stream=False,
+        suite='',
+        output=''
+    )
+
+    opts = parser.parse_args()[0]
+
+    suites = [opts.suite] if opts.suite else sorted(SUITES)
+    results = {
+        'environment': environment(),
+        'results': [SUITES[suite](opts) for suite in suites]
+    }
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import threading
+import time
+import traceback
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests to a service that keeps failing.
+    After failure_threshold failures in a row the breaker opens and allow() returns False,
+    meanwhile probe() is called every probe_interval seconds on a background thread
+    and the first probe returning True closes the breaker again.
+    """
+
+    CLOSED, OPEN = 'closed', 'open'
+
+    def __init__(self, probe, failure_threshold=3, probe_interval=10.0, name='breaker'):
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.name = name
+
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.lock = threading.Lock()
+
+        self.opened = 0
+        self.probes = 0
+        self.opened_at = 0
+
+    def allow(self):
+        return self.state == CircuitBreaker.CLOSED
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                return
+
+            self.failures += 1
+            if self.state == CircuitBreaker.OPEN or not self.failure_threshold or self.failures < self.failure_threshold:
+                return
+            self.state = CircuitBreaker.OPEN
+            self.opened += 1
+            self.opened_at = time.time()
+
+        print('INF: %s: %d failures in a row, probing until it recovers' % (self.name, self.failures))
+        thread = threading.Thread(target=self.probing, name=self.name + '-probe')
+        thread.daemon = True
+        thread.start()
+
+    def probing(self):
+        while True:
+            time.sleep(self.probe_interval)
+            self.probes += 1
+            try:
+                recovered = self.probe()
+            except:
+                traceback.print_exc()
+                recovered = False
+
+            if recovered:
+                with self.lock:
+                    self.state = CircuitBreaker.CLOSED
+                    self.failures = 0
+                print('INF: %s: recovered after %.1fs' % (self.name, time.time() - self.opened_at))
+                return
+
+    def stats(self):
+        return {
+            'open': int(self.state == CircuitBreaker.OPEN),
+            'failures': self.failures,
+            'opened': self.opened,
+            'probes': self.probes
+        }
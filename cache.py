@@ -0,0 +1,349 @@
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+APOSTROPHE_PATTERN = re.compile(u"['\u2019]", re.UNICODE)
+NORMALIZE_PATTERN = re.compile(r'[^\w\s]', re.UNICODE)
+
+def normalize_text(text):
+    # case, punctuation and spacing differences in recognized speech don't change the question
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+    text = APOSTROPHE_PATTERN.sub('', text.lower())
+    return ' '.join(NORMALIZE_PATTERN.sub(' ', text).split())
+
+
+class ResponseCache(object):
+    """
+    LRU cache of chat responses with a time to live, keyed on the normalized question,
+    the namespace (e.g. system prompt and model) and optionally some previous messages as context.
+    Limited by number of entries and total size of responses in bytes.
+    When a path is given, entries are loaded from it and save() writes them back.
+    """
+
+    def __init__(self, max_entries=256, max_bytes=1 << 20, ttl=3600, namespace='', path=None, save_interval=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.namespace = namespace
+        self.path = path
+        self.save_interval = save_interval
+
+        self.entries = collections.OrderedDict()   # key -> (response, expires timestamp), oldest first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_save = time.time()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.path:
+            self.load()
+
+    def key(self, text, context=[]):
+        parts = [self.namespace, normalize_text(text)] + [m['role'] + ':' + normalize_text(m['content']) for m in context]
+        return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
+
+    def get(self, text, context=[]):
+        key = self.key(text, context)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and entry[1] > time.time():
+                # most recently used goes to the end
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[0]
+
+            if entry:
+                self.size -= len(entry[0])
+                self.dirty = True
+            self.misses += 1
+
+    def put(self, text, context, response):
+        if not response or len(response) > self.max_bytes:
+            return
+
+        key = self.key(text, context)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= len(old[0])
+            self.entries[key] = (response, time.time() + self.ttl)
+            self.size += len(response)
+            self.dirty = True
+            self.evict()
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, (response, _) = self.entries.popitem(last=False)
+            self.size -= len(response)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        now = time.time()
+        with self.lock:
+            for key, response, expires in entries:
+                if expires > now:
+                    response = response.encode('utf-8')
+                    self.entries[key] = (response, expires)
+                    self.size += len(response)
+            self.evict()
+
+    def save(self, force=False):
+        """Writes entries to path when changed, at most every save_interval seconds unless forced"""
+        if not self.path or not self.dirty:
+            return
+        if not force and time.time() - self.last_save < self.save_interval:
+            return
+
+        with self.lock:
+            entries = [[key, response, expires] for key, (response, expires) in self.entries.items()]
+            self.dirty = False
+            self.last_save = time.time()
+
+        # write to a temporary file first, so a crash never leaves a broken cache file
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmp_path, self.path)
+
+
+NGRAM_SIZE = 3
+NGRAM_FEATURES = 1 << 18    # character n-grams are hashed into this many features
+ROUNDING = 1e-9             # scores summed in a different order may differ this much
+SKIP_SHARE = 0.7            # common n-grams of a query are skipped while they can add this share of the threshold at most
+
+def ngram_features(text, n=NGRAM_SIZE):
+    """Returns the hashed character n-gram features of text and their sublinear term frequency"""
+    text = ' ' + normalize_text(text) + ' '
+    hashed = [zlib.crc32(text[i:i + n].encode('utf-8')) & (NGRAM_FEATURES - 1) for i in range(len(text) - n + 1)]
+    if not hashed:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    features, counts = np.unique(hashed, return_counts=True)
+    return features, 1 + np.log(counts)
+
+
+def slice_indices(starts, lengths):
+    """Indices of the slices starts[i]:starts[i] + lengths[i] one after the other"""
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(offsets[-1] + lengths[-1] if len(lengths) else 0)
+
+
+class SimilarityIndex(object):
+    """
+    Finds answers of previously answered questions that are worded a bit differently,
+    using cosine similarity of L2-normalized character n-gram TF-IDF vectors.
+    The vectors form a sparse matrix stored by feature (the postings of each n-gram) and by entry (its row).
+    Only entries scoring at least threshold are of interest: the most common n-grams of a query are skipped
+    as long as together they can't add more than SKIP_SHARE of the threshold to any score, entries are found
+    by the postings of the others and those that can't reach the threshold even with the skipped ones are left out,
+    the rest is scored with their whole rows. New entries are appended as rows scored in full, they're merged
+    into the matrix, and all vectors weighted with the updated idf, once there are as many as compiled ones
+    or merge_every of them.
+    """
+
+    def __init__(self, threshold=0.8, merge_every=256):
+        self.threshold = threshold
+        self.merge_every = merge_every
+
+        self.questions = []
+        self.answers = []
+        self.features = []      # (features, term frequency) of each entry
+        self.df = np.zeros(NGRAM_FEATURES, dtype=np.int32)  # document frequency of each feature
+        self.lock = threading.Lock()
+
+        # matrix of the first `compiled` entries, indptr[f]:indptr[f+1] are the postings of feature f
+        # and rows_indptr[e]:rows_indptr[e+1] the features of entry e in the rows
+        self.compiled = 0
+        self.idf = np.ones(NGRAM_FEATURES)
+        self.indptr = np.zeros(NGRAM_FEATURES + 1, dtype=np.int64)
+        self.postings_entries = np.zeros(0, dtype=np.intp)
+        self.postings_weights = np.zeros(0)
+        self.max_weights = np.zeros(NGRAM_FEATURES)    # highest weight in the postings of each feature
+        self.query_weights = np.zeros(NGRAM_FEATURES)  # weights of the query being scored, 0 otherwise
+        self.rows_indptr = np.zeros(1, dtype=np.int64)
+        self.rows_features = np.zeros(0, dtype=np.int64)
+        self.rows_weights = np.zeros(0)
+
+        # rows appended since as (entries, features, weights) for each of their n-grams, joined once queried
+        self.appended = []
+        self.appended_rows = None
+
+    def __len__(self):
+        return len(self.questions)
+
+    def add(self, question, answer, rebuild=True):
+        features, tf = ngram_features(question)
+        if not len(features):
+            return
+
+        with self.lock:
+            entry = len(self.questions)
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.features.append((features, tf))
+            self.df[features] += 1
+
+            self.appended.append((np.repeat(entry, len(features)), features, self.weights(features, tf)))
+            self.appended_rows = None
+
+            # merged while the index is small too, so the idf follows what has been learned so far
+            appended = len(self.questions) - self.compiled
+            if rebuild and appended >= min(self.merge_every, max(self.compiled, 1)):
+                self.rebuild()
+
+    def load_faq(self, path):
+        """Loads a json list of {"question": ..., "answer": ...}, "questions" can be a list of variants"""
+        with open(path, 'r') as f:
+            entries = json.load(f)
+
+        for entry in entries:
+            answer = entry['answer'].encode('utf-8')
+            for question in entry.get('questions') or [entry['question']]:
+                self.add(question, answer, rebuild=False)
+
+        with self.lock:
+            self.rebuild()
+
+    def weights(self, features, tf):
+        weights = tf * self.idf[features]
+        return weights / np.sqrt(np.dot(weights, weights))
+
+    def rebuild(self):
+        count = len(self.questions)
+        if not count:
+            return
+
+        self.idf = np.log((count + 1.0) / (self.df + 1.0)) + 1
+
+        lengths = np.array([len(f) for f, _ in self.features])
+        features = np.concatenate([f for f, _ in self.features])
+        entries = np.repeat(np.arange(count, dtype=np.intp), lengths)
+
+        weights = np.concatenate([tf for _, tf in self.features]) * self.idf[features]
+        norms = np.sqrt(np.bincount(entries, weights=weights * weights, minlength=count))
+        weights /= norms[entries]
+
+        self.rows_indptr = np.concatenate(([0], np.cumsum(lengths)))
+        self.rows_features = features
+        self.rows_weights = weights
+
+        order = np.argsort(features, kind='mergesort')
+        self.postings_entries = entries[order]
+        self.postings_weights = weights[order]
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(features, minlength=NGRAM_FEATURES))))
+        # empty postings in between start where the next one does, so each reduced slice is one feature's
+        used = np.flatnonzero(np.diff(self.indptr))
+        self.max_weights = np.zeros(NGRAM_FEATURES)
+        self.max_weights[used] = np.maximum.reduceat(self.postings_weights, self.indptr[used])
+        self.compiled = count
+
+        self.appended = []
+        self.appended_rows = None
+
+    def best(self, features, weights):
+        """Returns (entry, score) of the most similar entry scoring at least threshold, or None"""
+        entries, scores = [], []
+        self.query_weights[features] = weights
+        try:
+            if self.compiled:
+                candidates = self.candidates(features, weights)
+                entries.append(candidates)
+                scores.append(self.rescore(candidates))
+
+            if self.appended:
+                if self.appended_rows is None:
+                    self.appended_rows = [np.concatenate(column) for column in zip(*self.appended)]
+                appended_entries, appended_features, appended_weights = self.appended_rows
+
+                products = self.query_weights[appended_features] * appended_weights
+                entries.append(np.arange(self.compiled, len(self.questions)))
+                scores.append(np.bincount(
+                    appended_entries - self.compiled, weights=products, minlength=len(self.questions) - self.compiled
+                ))
+        finally:
+            self.query_weights[features] = 0
+
+        entries, scores = np.concatenate(entries), np.concatenate(scores)
+        if not len(entries):
+            return None
+        best = int(scores.argmax())
+        if scores[best] >= self.threshold:
+            return int(entries[best]), float(scores[best])
+
+    def candidates(self, features, weights):
+        """Compiled entries that may score at least threshold"""
+        starts = self.indptr[features]
+        lengths = self.indptr[features + 1] - starts
+
+        # what the most common n-grams can add to any score at most: their weights times the highest in their postings,
+        # and no more than the norm of that part of the query
+        order = np.argsort(-lengths, kind='mergesort')
+        norms = np.sqrt(np.cumsum(weights[order] ** 2))
+        bounds = np.minimum(np.cumsum(weights[order] * self.max_weights[features[order]]), norms)
+        skipped = int(np.searchsorted(bounds, self.threshold * SKIP_SHARE))
+        used = order[skipped:]
+
+        # the matrix columns of the other n-grams are contiguous postings, their weighted sum is a partial product
+        postings = slice_indices(starts[used], lengths[used])
+        entries = self.postings_entries[postings]
+        products = self.postings_weights[postings] * np.repeat(weights[used], lengths[used])
+        partial = np.bincount(entries, weights=products, minlength=self.compiled)
+        if not skipped:
+            return np.flatnonzero(partial >= self.threshold - ROUNDING)
+
+        candidates = np.flatnonzero(partial >= self.threshold - bounds[skipped - 1] - ROUNDING)
+        if len(candidates):
+            # the skipped n-grams of an entry are at most what its norm leaves besides the ones looked up
+            looked_up = np.bincount(entries, weights=self.postings_weights[postings] ** 2, minlength=self.compiled)[candidates]
+            rest = np.minimum(bounds[skipped - 1], norms[skipped - 1] * np.sqrt(np.maximum(1 - looked_up, 0)))
+            candidates = candidates[partial[candidates] + rest >= self.threshold - ROUNDING]
+        return candidates
+
+    def rescore(self, candidates):
+        """Exact cosine similarity of the query with the compiled candidates, from their whole rows"""
+        starts = self.rows_indptr[candidates]
+        lengths = self.rows_indptr[candidates + 1] - starts
+        rows = slice_indices(starts, lengths)
+        products = self.query_weights[self.rows_features[rows]] * self.rows_weights[rows]
+        return np.bincount(np.repeat(np.arange(len(candidates)), lengths), weights=products, minlength=len(candidates))
+
+    def query(self, question):
+        """Returns (answer, score, matched question) of the most similar entry above threshold, or None"""
+        features, tf = ngram_features(question)
+        if not len(features):
+            return None
+
+        with self.lock:
+            if not self.questions:
+                return None
+
+            match = self.best(features, self.weights(features, tf))
+            if match:
+                entry, score = match
+                return self.answers[entry], score, self.questions[entry]
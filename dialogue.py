@@ -0,0 +1,189 @@
+import csv
+import json
+import os
+import threading
+import time
+import Queue
+import StringIO
+
+from metrics import SPANS
+
+CSV_FIELDS = ('time', 'turn', 'role', 'content', 'tags') + tuple(span + '_seconds' for span in SPANS)
+
+
+class DialogueLog(object):
+    """
+    Append-only conversation log written by a background thread, so logging never blocks speaking.
+    Records go through a bounded queue (dropped and counted when it's full), are written in batches,
+    flushed and fsynced at most every flush_interval seconds.
+    The file is rotated like logging.RotatingFileHandler (path.1 is the newest backup) when it's bigger than
+    max_bytes or has been written to for max_age seconds, 0 disables either.
+    Paths ending with .jsonl are written as json lines, anything else as csv.
+    """
+
+    def __init__(self, path='dialogue.csv', max_queue=1024, flush_interval=1.0, fsync=True,
+                 max_bytes=10 << 20, max_age=0, backups=5):
+        self.path = path
+        self.jsonl = path.endswith('.jsonl')
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backups = backups
+
+        self.queue = Queue.Queue(max_queue)
+        self.file = None
+        self.size = 0
+        self.opened = 0
+        self.dirty = False
+        self.last_flush = time.time()
+
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run, name='DialogueLog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def log_turn(self, turn, user, assistant):
+        """Logs both messages of a turn, latencies go with the assistant's message"""
+        tags = ' '.join(sorted(turn.tags))
+        self.write({
+            'time': turn.timestamps.get('stt') or time.time(), 'turn': turn.id,
+            'role': 'user', 'content': user, 'tags': tags
+        })
+
+        record = {
+            'time': turn.timestamps.get('tts_start') or time.time(), 'turn': turn.id,
+            'role': 'assistant', 'content': assistant, 'tags': tags
+        }
+        record.update((span + '_seconds', round(value, 4)) for span, value in turn.spans().items())
+        self.write(record)
+
+    def write(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        try:
+            self.queue.put(None, timeout=timeout)
+        except Queue.Full:
+            return
+        self.thread.join(timeout)
+
+    def stats(self):
+        return {
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped,
+            'rotations': self.rotations,
+            'errors': self.errors
+        }
+
+    def run(self):
+        while True:
+            try:
+                record = self.queue.get(timeout=self.flush_interval)
+            except Queue.Empty:
+                record = False
+
+            # take whatever else is waiting, to write it in one go
+            batch = [record] if record else []
+            while record is not None:
+                try:
+                    record = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if record is not None:
+                    batch.append(record)
+
+            try:
+                if batch:
+                    self.write_batch(batch)
+                if record is None or time.time() - self.last_flush >= self.flush_interval:
+                    self.flush()
+            except (IOError, OSError) as e:
+                # the sd card is full or gone, keep going without the log rather than breaking conversations
+                self.errors += 1
+                print('ERR: Dialogue log: %s' % str(e))
+                self.close_file()
+
+            if record is None:
+                self.close_file()
+                return
+
+    def write_batch(self, batch):
+        if self.file and self.should_rotate():
+            self.rotate()
+        if not self.file:
+            self.open()
+
+        if self.jsonl:
+            data = ''.join(json.dumps(record) + '\n' for record in batch)
+        else:
+            data = self.csv_rows([[self.format(field, record.get(field)) for field in CSV_FIELDS] for record in batch])
+
+        self.file.write(data)
+        self.size += len(data)
+        self.written += len(batch)
+        self.dirty = True
+
+    def format(self, field, value):
+        if value is None:
+            return ''
+        if field == 'time':
+            return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(value)) + '.%03d' % (value % 1 * 1000)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def csv_rows(self, rows):
+        data = StringIO.StringIO()
+        csv.writer(data).writerows(rows)
+        return data.getvalue()
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.opened = time.time()
+        if not self.jsonl and self.size == 0:
+            header = self.csv_rows([CSV_FIELDS])
+            self.file.write(header)
+            self.size += len(header)
+
+    def close_file(self):
+        if self.file:
+            try:
+                self.flush()
+                self.file.close()
+            except (IOError, OSError):
+                pass
+            self.file = None
+
+    def flush(self):
+        if self.file and self.dirty:
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+            self.dirty = False
+        self.last_flush = time.time()
+
+    def should_rotate(self):
+        if self.max_bytes and self.size >= self.max_bytes:
+            return True
+        return self.max_age and time.time() - self.opened >= self.max_age
+
+    def rotate(self):
+        self.close_file()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.rename('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.rotations += 1
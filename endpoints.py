@@ -0,0 +1,196 @@
+import collections
+import json
+import random
+import threading
+import time
+import Queue
+
+import numpy as np
+
+from tools import http_pool, Cancellable
+from metrics import metrics
+
+LATENCY_WINDOW = 100    # recent latencies of each endpoint the hedge delay is taken from
+MIN_SAMPLES = 10        # latencies needed before the tracked p95 is used as hedge delay
+EWMA_ALPHA = 0.2        # weight of the newest latency and error in the moving averages
+
+
+class RecognitionError(Exception):
+    pass
+
+
+class Endpoint(object):
+    """A speech recognition service with its recent latencies and error rate"""
+
+    def __init__(self, url):
+        self.url = url
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.latency = None     # moving average of successful requests, None until the first one
+        self.error_rate = 0.0
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+
+    def observe(self, latency, error=False):
+        self.requests += 1
+        self.error_rate += EWMA_ALPHA * ((1.0 if error else 0.0) - self.error_rate)
+        if error:
+            self.errors += 1
+            return
+        self.latencies.append(latency)
+        self.latency = latency if self.latency is None else self.latency + EWMA_ALPHA * (latency - self.latency)
+
+    def p95(self, default):
+        if len(self.latencies) < MIN_SAMPLES:
+            return default
+        return float(np.percentile(self.latencies, 95))
+
+    def score(self):
+        # endpoints never used yet are tried first, so every endpoint gets measured
+        if self.latency is None:
+            return self.inflight
+        return self.latency * (1 + self.inflight) / max(1 - self.error_rate, 0.05)
+
+
+class SpeechRecognizer(object):
+    """
+    Sends recordings to the fastest of several speech recognition endpoints.
+    When the first attempt hasn't answered after the p95 latency of its endpoint (hedge_delay until known),
+    a second copy goes to the next best endpoint and whichever answers first wins, the other one is cancelled.
+    Failed attempts are retried on the next best endpoint (the same one when there is no other) after a jittered exponential backoff,
+    at most retries times and only until deadline seconds after the recording was sent.
+    """
+
+    def __init__(self, urls, route='/speech/recognition', api_key='no-key',
+                 deadline=10.0, retries=2, backoff=0.2, hedge=True, hedge_delay=1.0):
+        self.endpoints = [Endpoint(url.strip()) for url in urls if url.strip()]
+        self.route = route
+        self.api_key = api_key
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.lock = threading.Lock()
+
+    def best(self, exclude=()):
+        """Returns the endpoint expected to answer first, None when all of them are excluded"""
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            return min(candidates, key=lambda e: e.score()) if candidates else None
+
+    def recognize(self, data):
+        """Returns the recognized text, or None when every attempt failed or the deadline passed"""
+        deadline = time.time() + self.deadline
+        results = Queue.Queue()
+        attempts = []   # (endpoint, cancel)
+        hedge = None    # cancel of the hedged attempt
+        running = 0
+        retries = 0
+
+        # timers wake up the blocking get, on python 2 waiting with a timeout polls
+        timers = [threading.Timer(self.deadline, results.put, [('deadline', None, None, None)])]
+
+        def launch(endpoint):
+            cancel = Cancellable()
+            attempts.append((endpoint, cancel))
+            thread = threading.Thread(target=self.attempt, args=(endpoint, data, deadline, cancel, results), name='SpeechRecognizer')
+            thread.daemon = True
+            thread.start()
+            return cancel
+
+        try:
+            first = self.best()
+            launch(first)
+            running = 1
+            if self.hedge:
+                timers.append(threading.Timer(first.p95(self.hedge_delay), results.put, [('hedge', None, None, None)]))
+            for timer in timers:
+                timer.start()
+
+            while True:
+                kind, endpoint, text, cancel = results.get()
+                if kind == 'deadline':
+                    metrics.increment('stt_deadline_exceeded')
+                    return None
+
+                if kind == 'hedge':
+                    # the first attempt is slower than usual, race a copy against it on another endpoint
+                    other = self.best(exclude=[attempts[0][0]])
+                    if running == 1 and len(attempts) == 1 and other:
+                        metrics.increment('stt_hedges')
+                        hedge = launch(other)
+                        running += 1
+                    continue
+
+                running -= 1
+                if kind == 'ok':
+                    if cancel is hedge:
+                        metrics.increment('stt_hedge_wins')
+                    return text
+
+                # failed, retry unless another attempt is still on its way
+                if running:
+                    continue
+                remaining = deadline - time.time()
+                if retries >= self.retries or remaining <= 0:
+                    metrics.increment('stt_failures')
+                    return None
+                retries += 1
+                metrics.increment('stt_retries')
+                time.sleep(min(random.uniform(0, self.backoff * 2 ** retries), remaining))
+                # on another endpoint if there is one, a single endpoint is retried itself
+                launch(self.best(exclude=[endpoint]) or endpoint)
+                running += 1
+        finally:
+            for timer in timers:
+                timer.cancel()
+            for _, cancel in attempts:
+                cancel.cancel()
+
+    def attempt(self, endpoint, data, deadline, cancel, results):
+        with self.lock:
+            endpoint.inflight += 1
+        start = time.time()
+        try:
+            text = self.send(endpoint, data, deadline, cancel)
+        except Exception as e:
+            if not cancel.cancelled:
+                print('ERR: Speech recognition on %s failed: %s' % (endpoint.url, e))
+            text = None
+        elapsed = time.time() - start
+        with self.lock:
+            endpoint.inflight -= 1
+            # a cancelled attempt took at least this long, that only tells something when it's slower than usual
+            if not cancel.cancelled:
+                endpoint.observe(elapsed, error=text is None)
+            elif elapsed > (endpoint.latency or 0):
+                endpoint.observe(elapsed)
+        results.put(('failed' if text is None else 'ok', endpoint, text, cancel))
+
+    def send(self, endpoint, data, deadline, cancel):
+        response = http_pool.urlopen(
+            'POST', endpoint.url + self.route, data,
+            {'Content-Type': 'audio/wav', 'Authorization': 'Bearer ' + (self.api_key or 'no-key')},
+            read_timeout=max(deadline - time.time(), 0.1), cancel=cancel
+        )
+        response_data = response.read()
+        if response.status >= 400:
+            raise RecognitionError('HTTP %d %s' % (response.status, response_data))
+
+        resp = json.loads(response_data)
+        if 'text' not in resp:
+            raise RecognitionError(resp.get('error') or 'No text in response')
+        return str(resp['text'])
+
+    def stats(self):
+        stats = {}
+        with self.lock:
+            for i, endpoint in enumerate(self.endpoints):
+                prefix = 'endpoint%d_' % i
+                stats[prefix + 'latency'] = endpoint.latency or 0.0
+                stats[prefix + 'p95'] = endpoint.p95(0.0)
+                stats[prefix + 'error_rate'] = endpoint.error_rate
+                stats[prefix + 'requests'] = endpoint.requests
+                stats[prefix + 'inflight'] = endpoint.inflight
+        return stats
@@ -0,0 +1,511 @@
+import base64
+import collections
+import hashlib
+import httplib
+import json
+import socket
+import sys
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+from optparse import OptionParser
+from tools import HTTPConnectionPool
+from stubs import ServiceHandler, start_process
+
+ROBOT_HEADER = 'X-Robot-Id'    # robots are told apart by this header, or by their address without it
+
+
+class Busy(Exception):
+    """A request got no slot in time, answered with 503 so the robot can tell it from a failed service"""
+
+
+class ConcurrencyLimits(object):
+    """
+    At most robot_limit requests of each robot and global_limit requests overall go upstream at a time.
+    Others wait in line for up to timeout seconds, at most max_queue of them, 0 means unlimited.
+    """
+
+    def __init__(self, global_limit=8, robot_limit=2, max_queue=64, timeout=10.0):
+        self.global_limit = global_limit
+        self.robot_limit = robot_limit
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self.cond = threading.Condition()
+        self.active = 0
+        self.robots = collections.defaultdict(int)  # robot -> active requests
+        self.waiting = 0
+
+        self.queued = 0
+        self.rejected = 0
+        self.max_waiting = 0
+
+    def available(self, robot):
+        if self.global_limit and self.active >= self.global_limit:
+            return False
+        return not self.robot_limit or self.robots[robot] < self.robot_limit
+
+    def acquire(self, robot):
+        deadline = time.time() + self.timeout
+        with self.cond:
+            if not self.available(robot):
+                if self.max_queue and self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    raise Busy('Too many requests waiting')
+
+                self.waiting += 1
+                self.queued += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+                try:
+                    while not self.available(robot):
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            raise Busy('Timed out waiting for a free slot')
+                        self.cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.active += 1
+            self.robots[robot] += 1
+
+    def release(self, robot):
+        with self.cond:
+            self.active -= 1
+            self.robots[robot] -= 1
+            if not self.robots[robot]:
+                del self.robots[robot]
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'active': self.active,
+                'robots': len(self.robots),
+                'waiting': self.waiting,
+                'max_waiting': self.max_waiting,
+                'queued': self.queued,
+                'rejected': self.rejected
+            }
+
+
+class Flight(object):
+    """
+    One upstream response, shared by identical requests arriving while it's in flight.
+    Each of them reads the body from the start, chunks are handed out as they arrive so streams stay streams.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.status = None
+        self.content_type = None
+        self.chunked = False
+        self.chunks = []
+        self.done = False
+
+    def begin(self, status, content_type, chunked):
+        with self.cond:
+            self.status, self.content_type, self.chunked = status, content_type, chunked
+            self.cond.notify_all()
+
+    def add(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.cond.notify_all()
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def fail(self, status, message):
+        with self.cond:
+            if self.status is None:
+                self.begin(status, 'application/json', False)
+                self.add(json.dumps({'error': message}))
+            self.finish()
+
+    def head(self):
+        """Waits for the response to start, returns (status, content type, chunked)"""
+        with self.cond:
+            while self.status is None:
+                self.cond.wait()
+            return self.status, self.content_type, self.chunked
+
+    def read(self):
+        i = 0
+        while True:
+            with self.cond:
+                while i == len(self.chunks) and not self.done:
+                    self.cond.wait()
+                chunks = self.chunks[i:]
+                done = self.done
+            for chunk in chunks:
+                yield chunk
+            i += len(chunks)
+            if done and i == len(self.chunks):
+                return
+
+
+class MicroBatcher(object):
+    """
+    Collects speech recognition uploads arriving within window seconds of each other, up to max_size,
+    and recognizes them with one call of send(authorization, bodies), which returns a result for each body.
+    Only uploads with the same authorization end up in the same batch, none waits longer than timeout seconds.
+    """
+
+    def __init__(self, send, window=0.02, max_size=8, timeout=60.0):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self.timeout = timeout
+        self.timeouts = 0
+
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.batches = 0
+        self.batched = 0
+
+        thread = threading.Thread(target=self.run, name='MicroBatcher')
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, authorization, body):
+        """Blocks until the upload is recognized, returns its result or None when the batch failed or timed out"""
+        item = {'authorization': authorization, 'body': body, 'done': threading.Event(), 'result': None}
+
+        # a timer ends the wait, on python 2 waiting with a timeout polls
+        timer = threading.Timer(self.timeout, item['done'].set)
+        timer.daemon = True
+        timer.start()
+        with self.cond:
+            self.pending.append(item)
+            self.cond.notify_all()
+        try:
+            item['done'].wait()
+        finally:
+            timer.cancel()
+
+        with self.cond:
+            if item in self.pending:
+                self.pending.remove(item)
+            if item['result'] is None and not item.get('dispatched'):
+                self.timeouts += 1
+        return item['result']
+
+    def matching(self, authorization):
+        return [item for item in self.pending if item['authorization'] == authorization][:self.max_size]
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+
+                authorization = self.pending[0]['authorization']
+                deadline = time.time() + self.window
+                while len(self.matching(authorization)) < self.max_size and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+
+                batch = self.matching(authorization)
+                for item in batch:
+                    self.pending.remove(item)
+                self.batches += 1
+                self.batched += len(batch)
+
+            thread = threading.Thread(target=self.dispatch, args=(authorization, batch), name='MicroBatcher-send')
+            thread.daemon = True
+            thread.start()
+
+    def dispatch(self, authorization, batch):
+        results = []
+        try:
+            results = self.send(authorization, [item['body'] for item in batch])
+            if not isinstance(results, list) or len(results) != len(batch):
+                print('ERR: Batch of %d recordings returned: %r' % (len(batch), results))
+        except Exception as e:
+            print('ERR: Batch of %d recordings failed: %s' % (len(batch), e))
+        finally:
+            if not isinstance(results, list):
+                results = []
+            # every upload gets an answer, the ones without a result fail
+            for i, item in enumerate(batch):
+                item['result'] = results[i] if i < len(results) else None
+                item['dispatched'] = True
+                item['done'].set()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'pending': len(self.pending),
+                'batches': self.batches,
+                'batched': self.batched,
+                'timeouts': self.timeouts,
+                'average_batch': self.batched / float(self.batches) if self.batches else 0.0
+            }
+
+
+class GatewayHandler(ServiceHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/stats':
+            self.send_json(self.server.stats())
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    def do_POST(self):
+        body = self.read_body()
+        route = self.path.split('?')[0]
+        robot = self.headers.get(ROBOT_HEADER) or self.client_address[0]
+
+        if route.endswith(self.server.speech_route):
+            self.recognize(body, robot)
+        elif route.endswith(self.server.chat_route):
+            self.chat(body, robot)
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    def recognize(self, body, robot):
+        server = self.server
+        try:
+            server.limits.acquire(robot)
+        except Busy as e:
+            self.send_json({'error': str(e)}, 503)
+            return
+
+        try:
+            server.count('speech')
+            authorization = server.speech_api_key or self.headers.get('Authorization') or ''
+            if server.batcher:
+                result = server.batcher.submit(authorization, body)
+                if result is None:
+                    self.send_json({'error': 'Speech recognition failed'}, 502)
+                else:
+                    self.send_json(result)
+                return
+
+            flight = Flight()
+            server.fetch(flight, server.speech_upstream + server.speech_route, body, {
+                'Content-Type': self.headers.get('Content-Type') or 'audio/wav',
+                'Authorization': authorization
+            })
+        finally:
+            server.limits.release(robot)
+        self.send_flight(flight)
+
+    def chat(self, body, robot):
+        server = self.server
+        server.count('chat')
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': server.api_key or self.headers.get('Authorization') or ''
+        }
+
+        # identical requests in flight get the same answer, the key covers everything sent upstream
+        key = hashlib.sha1(headers['Authorization'] + '\n' + body).hexdigest()
+        flight, leader = server.join(key)
+        if not leader:
+            server.count('deduplicated')
+        else:
+            try:
+                server.limits.acquire(robot)
+            except Busy as e:
+                flight.fail(503, str(e))
+                server.land(key)
+            else:
+                thread = threading.Thread(
+                    target=self.fetch_chat, args=(flight, key, body, headers, robot), name='Gateway-chat'
+                )
+                thread.daemon = True
+                thread.start()
+
+        self.send_flight(flight)
+
+    def fetch_chat(self, flight, key, body, headers, robot):
+        # on its own thread, requests sharing the flight still get the answer when this client goes away
+        server = self.server
+        try:
+            server.fetch(flight, server.upstream + server.chat_route, body, headers)
+        finally:
+            server.land(key)
+            server.limits.release(robot)
+
+    def send_flight(self, flight):
+        status, content_type, chunked = flight.head()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in flight.read():
+                self.send_chunk(chunk)
+            self.send_chunk('')
+        else:
+            body = ''.join(flight.read())
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+
+class Gateway(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Sits between a fleet of robots and the speech recognition and chat completion services, with the same routes
+    so robots only need their url changed. Upstream connections are pooled, identical chat requests in flight
+    are sent upstream once, ConcurrencyLimits apply per robot and overall, and with batch_route speech
+    recognition uploads are sent upstream in batches (see MicroBatcher and StubServer for the format).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, upstream, host='0.0.0.0', port=8080, speech_upstream=None,
+                 speech_route='/speech/recognition', chat_route='/chat/completions', api_key=None, speech_api_key=None,
+                 global_limit=8, robot_limit=2, max_queue=64, queue_timeout=10.0,
+                 batch_route=None, batch_window=0.02, batch_size=8, batch_timeout=60.0, pool_size=16):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), GatewayHandler)
+        self.upstream = upstream.rstrip('/')
+        self.speech_upstream = (speech_upstream or upstream).rstrip('/')
+        self.speech_route = speech_route
+        self.chat_route = chat_route
+        self.api_key = 'Bearer ' + api_key if api_key else None
+        self.speech_api_key = 'Bearer ' + speech_api_key if speech_api_key else self.api_key
+
+        self.pool = HTTPConnectionPool(max_size=pool_size)
+        self.limits = ConcurrencyLimits(global_limit, robot_limit, max_queue, queue_timeout)
+        self.batch_route = batch_route
+        self.batcher = MicroBatcher(self.send_batch, batch_window, batch_size, batch_timeout) if batch_route else None
+
+        self.flights = {}   # request key -> Flight
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def join(self, key):
+        """Returns (flight, leader), the leader has to send the request and land() it when done"""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight:
+                return flight, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def land(self, key):
+        with self.lock:
+            self.flights.pop(key, None)
+
+    def fetch(self, flight, url, body, headers):
+        self.count('upstream')
+        try:
+            response = self.pool.urlopen('POST', url, body, headers)
+            flight.begin(
+                response.status, response.response.getheader('Content-Type') or 'application/json',
+                bool(response.response.chunked)
+            )
+            if response.status >= 400:
+                self.count('upstream_errors')
+            for chunk in response.iter_chunks():
+                flight.add(chunk)
+        except (socket.error, httplib.HTTPException) as e:
+            self.count('upstream_errors')
+            flight.fail(502, 'Upstream failed: %s' % e)
+        finally:
+            flight.finish()
+
+    def send_batch(self, authorization, bodies):
+        self.count('upstream')
+        response = self.pool.urlopen(
+            'POST', self.speech_upstream + self.batch_route,
+            json.dumps({'files': [base64.b64encode(body) for body in bodies]}),
+            {'Content-Type': 'application/json', 'Authorization': authorization}
+        )
+        data = response.read()
+        if response.status >= 400:
+            self.count('upstream_errors')
+            print('ERR: Batch speech recognition: %d %s' % (response.status, data))
+            return [None] * len(bodies)
+        return json.loads(data)['results']
+
+    def handle_error(self, request, client_address):
+        # robots cancel requests by closing the connection
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def stats(self):
+        with self.lock:
+            stats = {'requests': dict(self.counters), 'in_flight': len(self.flights)}
+        stats['limits'] = self.limits.stats()
+        if self.batcher:
+            stats['batches'] = self.batcher.stats()
+        return stats
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='Gateway')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.pool.clear()
+
+
+def main():
+    parser = OptionParser(usage='python gateway.py --upstream <url> [options]')
+    parser.add_option("--host", help="Address to listen on, default 0.0.0.0", dest="host")
+    parser.add_option("--port", help="Port to listen on, default 8080", dest="port", type="int")
+    parser.add_option("--upstream", help="Base url of the chat completion (and speech recognition) service", dest="upstream")
+    parser.add_option("--speech-upstream", help="Base url of the speech recognition service, default --upstream", dest="speech_upstream")
+    parser.add_option("--chat-route", help="Route of chat completion service, default '/chat/completions'", dest="chat_route")
+    parser.add_option("--speech-route", help="Route of speech recognition service, default '/speech/recognition'", dest="speech_route")
+    parser.add_option("--api-key", help="API key sent upstream instead of the robots' ones", dest="api_key")
+    parser.add_option("--speech-api-key", help="API key of the speech recognition service, default --api-key", dest="speech_api_key")
+    parser.add_option("--max-concurrency", help="Requests sent upstream at a time, 0 for unlimited, default 8", dest="global_limit", type="int")
+    parser.add_option("--robot-concurrency", help="Requests of one robot sent upstream at a time, 0 for unlimited, default 2", dest="robot_limit", type="int")
+    parser.add_option("--max-queue", help="Requests waiting for a free slot before new ones are rejected, default 64", dest="max_queue", type="int")
+    parser.add_option("--queue-timeout", help="Seconds a request waits for a free slot, default 10", dest="queue_timeout", type="float")
+    parser.add_option("--batch-route", help="Route of the batch speech recognition service, enables batching", dest="batch_route")
+    parser.add_option("--batch-window", help="Seconds uploads are collected for a batch, default 0.02", dest="batch_window", type="float")
+    parser.add_option("--batch-size", help="Maximum uploads in a batch, default 8", dest="batch_size", type="int")
+    parser.add_option("--batch-timeout", help="Seconds an upload waits for the result of its batch, default 60", dest="batch_timeout", type="float")
+    parser.add_option("--pool-size", help="Idle keep-alive connections kept to each upstream, default 16", dest="pool_size", type="int")
+    parser.add_option("--stub", help="Run against local stub services with this latency profile (none, local, cloud, flaky) instead of --upstream", dest="stub")
+    parser.set_defaults(
+        host='0.0.0.0', port=8080, chat_route='/chat/completions', speech_route='/speech/recognition',
+        global_limit=8, robot_limit=2, max_queue=64, queue_timeout=10.0,
+        batch_window=0.02, batch_size=8, batch_timeout=60.0, pool_size=16
+    )
+    opts = parser.parse_args()[0]
+
+    upstream = opts.upstream
+    if opts.stub:
+        upstream = start_process(
+            profile=opts.stub, speech_route=opts.speech_route, chat_route=opts.chat_route, batch_route=opts.batch_route
+        )[1]
+        print('INF: Stub services on %s' % upstream)
+    if not upstream:
+        print('Error: Upstream not specified!')
+        return
+
+    gateway = Gateway(
+        upstream, opts.host, opts.port, opts.speech_upstream, opts.speech_route, opts.chat_route,
+        opts.api_key, opts.speech_api_key, opts.global_limit, opts.robot_limit, opts.max_queue, opts.queue_timeout,
+        opts.batch_route, opts.batch_window, opts.batch_size, opts.batch_timeout, opts.pool_size
+    )
+    print('INF: Gateway listening on %s, forwarding to %s' % (gateway.url, upstream))
+    try:
+        gateway.serve_forever()
+    except KeyboardInterrupt:
+        print("Interrupted by user, shutting down")
+        gateway.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import json
+import re
+import threading
+import time
+
+# roughly how BPE tokenizers split text: short word pieces and single punctuation marks
+TOKEN_PATTERN = re.compile(r'\w{1,4}|[^\w\s]', re.UNICODE)
+MESSAGE_OVERHEAD = 4    # tokens used by role and separators of each message
+
+def estimate_tokens(text):
+    return len(TOKEN_PATTERN.findall(text or ''))
+
+def message_tokens(message):
+    return estimate_tokens(message['content']) + MESSAGE_OVERHEAD
+
+
+class ConversationHistory(object):
+    """
+    Messages sent to chat completion, kept within a token and/or character budget.
+    The system prompt is always kept, oldest turns are evicted first and optionally summarized
+    by summarizer(previous_summary, evicted_messages) when compact() is called.
+    The conversation resets when idle for longer than idle_timeout seconds.
+    A budget or timeout of 0 means unlimited.
+    Safe to use from several threads, e.g. a reset event while a turn is being answered.
+    """
+
+    def __init__(self, system_prompt, max_tokens=0, max_chars=0, idle_timeout=0, summarizer=None):
+        self.system_prompt = system_prompt
+        self.max_tokens = max_tokens
+        self.max_chars = max_chars
+        self.idle_timeout = idle_timeout
+        self.summarizer = summarizer
+        self.lock = threading.RLock()
+        self.generation = 0     # incremented on reset, so a summary of the old conversation isn't applied
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.system = {'role': 'system', 'content': self.system_prompt}
+            self.summary = ''
+            self.turns = []
+            self.evicted = []
+            self.last_active = time.time()
+            self.generation += 1
+
+    def add(self, role, content):
+        with self.lock:
+            now = time.time()
+            if self.idle_timeout and now - self.last_active > self.idle_timeout:
+                self.reset()
+            self.last_active = now
+
+            self.turns.append({'role': role, 'content': content})
+            self.trim()
+
+    def pinned(self):
+        pinned = [self.system]
+        if self.summary:
+            pinned.append({'role': 'system', 'content': 'Summary of the earlier conversation: ' + self.summary})
+        return pinned
+
+    def messages(self):
+        with self.lock:
+            return self.pinned() + self.turns
+
+    def over_budget(self, messages):
+        if self.max_tokens and sum(message_tokens(m) for m in messages) > self.max_tokens:
+            return True
+        if self.max_chars and sum(len(m['content']) for m in messages) > self.max_chars:
+            return True
+        return False
+
+    def trim(self):
+        pinned = self.pinned()
+        # evict oldest messages, but always keep the latest one
+        while len(self.turns) > 1 and self.over_budget(pinned + self.turns):
+            self.evicted.append(self.turns.pop(0))
+
+        # don't start the window with an assistant reply that lost its question
+        while len(self.turns) > 1 and self.turns[0]['role'] == 'assistant':
+            self.evicted.append(self.turns.pop(0))
+
+    def compact(self):
+        """Summarizes evicted messages, call it outside of the latency critical path"""
+        with self.lock:
+            if not self.evicted:
+                return
+            evicted, self.evicted = self.evicted, []
+            summary, generation = self.summary, self.generation
+
+        if self.summarizer:
+            # no lock while waiting for the summary, turns can still be added meanwhile
+            summary = self.summarizer(summary, evicted)
+            with self.lock:
+                if summary and generation == self.generation:
+                    self.summary = summary
+                    # the summary itself takes budget too, anything evicted now is summarized next time
+                    self.trim()
+
+    def payload_size(self, messages=None):
+        """Returns (bytes, estimated tokens) of the messages sent in a request"""
+        messages = messages or self.messages()
+        return len(json.dumps(messages)), sum(message_tokens(m) for m in messages)
@@ -0,0 +1,253 @@
+import collections
+import itertools
+import json
+import threading
+import time
+import BaseHTTPServer
+
+import numpy as np
+
+# timestamps recorded for each conversational turn, in pipeline order
+STAGES = (
+    'onset',            # speech detected (threshold crossing)
+    'endpoint',         # recording stopped
+    'encoded',          # wav encoded
+    'stt',              # speech recognition response
+    'filler',           # filler said while the chat completion is late
+    'llm_first_byte',   # first piece of the chat completion
+    'llm_last_byte',    # whole chat completion received
+    'tts_start',
+    'tts_end',
+)
+
+# latencies reported for each turn: name -> (from stage, to stage)
+SPANS = collections.OrderedDict([
+    ('speech', ('onset', 'endpoint')),
+    ('encode', ('endpoint', 'encoded')),
+    ('stt', ('endpoint', 'stt')),
+    ('llm_first_byte', ('stt', 'llm_first_byte')),
+    ('llm', ('stt', 'llm_last_byte')),
+    ('response', ('endpoint', 'tts_start')),
+    ('tts', ('tts_start', 'tts_end')),
+    ('turn', ('onset', 'tts_end')),
+])
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Turn(object):
+    def __init__(self, turn_id):
+        self.id = turn_id
+        self.timestamps = {}
+        self.text = ''
+        self.tags = set()   # e.g. cache hit, empty recognition
+
+    def mark(self, stage, timestamp=None):
+        self.timestamps[stage] = timestamp or time.time()
+
+    def spans(self):
+        spans = {}
+        for name, (start, end) in SPANS.items():
+            if start in self.timestamps and end in self.timestamps:
+                spans[name] = self.timestamps[end] - self.timestamps[start]
+        return spans
+
+    def to_dict(self):
+        return {
+            'turn': self.id,
+            'text': self.text,
+            'tags': sorted(self.tags),
+            'timestamps': self.timestamps,
+            'spans': self.spans()
+        }
+
+
+class Histogram(object):
+    """Cumulative bucket counts for prometheus, plus a window of recent values for percentiles"""
+
+    def __init__(self, window=1024):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def quantiles(self):
+        if not self.recent:
+            return {}
+        values = np.percentile(np.array(self.recent), [q * 100 for q in QUANTILES])
+        return dict(('p%d' % (q * 100), float(v)) for q, v in zip(QUANTILES, values))
+
+
+class Metrics(object):
+    """
+    Collects per turn latencies and counters of the whole process.
+    Modules mark stages on the Turn they're working on, finish() adds its spans to the histograms.
+    """
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+
+        self.histograms = collections.OrderedDict((name, Histogram(window)) for name in SPANS)
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}            # name -> function returning a dict of values
+        self.recognized = {}        # text -> turns raised as SpeechRecognition events, oldest first
+        self.finished = []          # finished turns not dumped yet
+
+    def start_turn(self, timestamp=None):
+        turn = Turn(next(self.ids))
+        turn.mark('onset', timestamp)
+        return turn
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def register_gauges(self, name, fn):
+        self.gauges[name] = fn
+
+    # SpeechRecognition events only carry the text, these hand over the turn to the receiver
+    def hand_over(self, turn, text):
+        turn.text = text
+        with self.lock:
+            # nobody claims texts when the receiver isn't running, don't let them pile up
+            if len(self.recognized) > 256:
+                self.recognized.clear()
+            self.recognized.setdefault(text, collections.deque()).append(turn)
+
+    def claim(self, text):
+        """Returns the turn the text was recognized in, or a new turn if it's unknown (e.g. raised by other modules)"""
+        with self.lock:
+            turns = self.recognized.get(text)
+            if turns:
+                turn = turns.popleft()
+                if not turns:
+                    del self.recognized[text]
+                return turn
+
+        turn = Turn(next(self.ids))
+        turn.text = text
+        return turn
+
+    def finish(self, turn, tag=None):
+        if tag:
+            turn.tags.add(tag)
+
+        with self.lock:
+            for name, value in turn.spans().items():
+                self.histograms[name].observe(value)
+            self.counters['turns'] += 1
+            for t in turn.tags:
+                self.counters['turns_' + t] += 1
+
+            self.finished.append(turn)
+            del self.finished[:-self.window]
+
+    def summary(self):
+        with self.lock:
+            summary = {
+                'latency': dict((name, h.quantiles()) for name, h in self.histograms.items() if h.count),
+                'counters': dict(self.counters)
+            }
+        for name, fn in self.gauges.items():
+            try:
+                summary[name] = fn()
+            except:
+                pass
+        return summary
+
+    def prometheus(self):
+        lines = [
+            '# HELP pepper_latency_seconds Latency of each stage of conversational turns',
+            '# TYPE pepper_latency_seconds histogram'
+        ]
+        with self.lock:
+            for name, h in self.histograms.items():
+                for bound, count in zip(BUCKETS, h.counts):
+                    lines.append('pepper_latency_seconds_bucket{span="%s",le="%s"} %d' % (name, bound, count))
+                lines.append('pepper_latency_seconds_bucket{span="%s",le="+Inf"} %d' % (name, h.count))
+                lines.append('pepper_latency_seconds_sum{span="%s"} %f' % (name, h.sum))
+                lines.append('pepper_latency_seconds_count{span="%s"} %d' % (name, h.count))
+
+            lines.append('# TYPE pepper_latency_quantile_seconds gauge')
+            for name, h in self.histograms.items():
+                for quantile, value in sorted(h.quantiles().items()):
+                    lines.append('pepper_latency_quantile_seconds{span="%s",quantile="%s"} %f' % (name, quantile, value))
+
+            lines.append('# TYPE pepper_events_total counter')
+            for name, value in sorted(self.counters.items()):
+                lines.append('pepper_events_total{name="%s"} %d' % (name, value))
+
+        lines.append('# TYPE pepper_state gauge')
+        for group, fn in sorted(self.gauges.items()):
+            try:
+                values = fn()
+            except:
+                continue
+            for name, value in sorted(values.items()):
+                if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+                    lines.append('pepper_state{group="%s",name="%s"} %f' % (group, name, value))
+
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='0.0.0.0'):
+        """Serves prometheus text format on http://host:port/metrics in a background thread"""
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name='MetricsServer')
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def dump(self, path):
+        """Appends finished turns and a summary as json lines"""
+        with self.lock:
+            turns, self.finished = self.finished, []
+
+        with open(path, 'a') as f:
+            for turn in turns:
+                f.write(json.dumps(turn.to_dict()) + '\n')
+            f.write(json.dumps({'summary': self.summary(), 'time': time.time()}) + '\n')
+
+    def start_dump(self, path, interval=60):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except IOError as e:
+                    print('ERR: Metrics dump failed: %s' % str(e))
+
+        thread = threading.Thread(target=run, name='MetricsDump')
+        thread.daemon = True
+        thread.start()
+
+# shared by all modules of the process
+metrics = Metrics()
@@ -1,11 +1,20 @@
 from naoqi import ALProxy, ALModule
+from tools import Debounce
+from metrics import metrics
+
+FACE_FOUND_DELAY = 0.0  # seconds a face has to be seen before eye contact starts
+FACE_LOST_DELAY = 1.0   # seconds a face has to be gone before eye contact ends
 
 class EyeContactModule(ALModule):
-    def __init__(self, name):
+    def __init__(self, name, face_found_delay=FACE_FOUND_DELAY, face_lost_delay=FACE_LOST_DELAY):
         ALModule.__init__(self, name)
         self.BIND_PYTHON( self.getName(),"callback" )
 
         self.face_detected = False
+
+        # FaceDetected fires on every update, faces briefly lost or found while people move around are ignored
+        self.face = Debounce(self.handle_status_change, face_found_delay, face_lost_delay)
+        metrics.register_gauges('eye_contact', self.face.stats)
         
         self.speech = ALProxy("ALTextToSpeech")
         self.memory = ALProxy("ALMemory")
@@ -17,10 +26,7 @@ class EyeContactModule(ALModule):
         self.stop()
 
     def on_face_detected(self, event_name, value):
-        if value and not self.face_detected:
-            self.handle_status_change(True)
-        elif not value and self.face_detected:
-            self.handle_status_change(False)
+        self.face.set(value)
 
     def handle_status_change(self, status):
         # print(status)
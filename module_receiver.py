@@ -1,5 +1,17 @@
 from naoqi import ALModule, ALProxy
-from tools import chat_completion
+from tools import chat_completion, chat_completion_stream, split_sentences, Cancellable, StreamInterrupted
+from history import ConversationHistory
+from cache import ResponseCache
+from metrics import metrics
+from dialogue import DialogueLog
+from workers import TurnScheduler
+from breaker import CircuitBreaker
+
+import random
+import threading
+import Queue
+
+SPECULATION_TIMEOUT = 10    # seconds a speculative answer waits to be confirmed before it's given up
 
 class BaseSpeechReceiverModule(ALModule):
     """
@@ -10,7 +22,13 @@ class BaseSpeechReceiverModule(ALModule):
     def __init__( 
             self, strModuleName, strNaoIp, port, 
             server_url, base_route, api_key, 
-            model_name, save_csv=False, system_prompt='' 
+            model_name, save_csv=False, system_prompt='', stream=False,
+            history_max_tokens=0, history_max_chars=0, history_idle_reset=0, history_summary=False,
+            cache_size=0, cache_ttl=3600, cache_context=0, cache_file=None,
+            similarity_index=None, similarity_learn=False, dialogue_log=None,
+            turn_policy='queue', turn_queue_size=2,
+            turn_deadline=0, filler_delay=0, fillers=(), fallback_reply='',
+            breaker_failures=3, breaker_probe_interval=10.0
         ):
         
         ALModule.__init__(self, strModuleName )
@@ -19,27 +37,70 @@ class BaseSpeechReceiverModule(ALModule):
         self.port = port
         self.strNaoIp = strNaoIp
 
-        self.messages = []
         self.system_prompt = system_prompt
-        self.reset_message()
+        self.history = ConversationHistory(
+            system_prompt or "You are an assistant names Pepper, your job is to answer users' questions in short.",
+            max_tokens=history_max_tokens, max_chars=history_max_chars, idle_timeout=history_idle_reset,
+            summarizer=self.summarize if history_summary else None
+        )
+
+        # one turn is answered at a time, turn_policy decides about questions asked meanwhile
+        self.turns = TurnScheduler(
+            self.answer, policy=turn_policy, max_pending=turn_queue_size,
+            cancel=self.cancel_turn, discard=self.discard_turn, name='Turns'
+        )
+        metrics.register_gauges('turns', self.turns.stats)
+
+        # cancel token of the turn being spoken, it can't be cancelled anymore
+        self.speaking = None
+        self.speaking_lock = threading.Lock()
 
-        self.response_finished = True
+        # speculation id -> turn being answered, or True/False when it got confirmed/cancelled before it arrived
+        self.speculations = {}
 
         self.server_url = server_url
         self.base_route = base_route
         self.api_key = api_key
         self.model_name = model_name
+        self.stream = stream
+
+        # the visitor doesn't wait longer than turn_deadline seconds for the first token, nor filler_delay in silence
+        self.turn_deadline = turn_deadline
+        self.filler_delay = filler_delay
+        self.fillers = [f for f in fillers if f]
+        self.fallback_reply = fallback_reply
+
+        # a failing chat completion service isn't waited for, only probed until it's back
+        self.breaker = CircuitBreaker(
+            self.probe, failure_threshold=breaker_failures, probe_interval=breaker_probe_interval, name='Chat completion'
+        )
+        metrics.register_gauges('llm_breaker', self.breaker.stats)
+
+        # answers of repeated questions, disabled when cache_size is 0
+        self.cache = None
+        self.cache_context = cache_context
+        if cache_size:
+            self.cache = ResponseCache(
+                max_entries=cache_size, ttl=cache_ttl,
+                namespace=[self.history.system_prompt, model_name], path=cache_file
+            )
+
+        # answers of similar questions, from a FAQ file and/or previous answers
+        self.similarity_index = similarity_index
+        self.similarity_learn = similarity_learn
+        if self.cache:
+            metrics.register_gauges('cache', self.cache.stats)
 
         self.speech = ALProxy('ALTextToSpeech')
         self.memory = ALProxy("ALMemory", self.strNaoIp, self.port)
         self.memory.subscribeToEvent("ResetConversation", self.getName(), "reset_message")
 
-        self.save_csv = save_csv
-
-        if self.save_csv:
-            with open('dialogue.csv', 'w') as f:
-                f.write('role,content\n')
-                f.close()
+        # conversation log, written in the background
+        self.dialogue_log = dialogue_log
+        if save_csv and not dialogue_log:
+            self.dialogue_log = DialogueLog('dialogue.csv')
+        if self.dialogue_log:
+            metrics.register_gauges('dialogue_log', self.dialogue_log.stats)
 
     # __init__ - end
     def __del__( self ):
@@ -47,20 +108,59 @@ class BaseSpeechReceiverModule(ALModule):
         self.stop()
 
     def reset_message(self):
-        self.messages = [{
-            "role":"system",
-            "content": self.system_prompt or "You are an assistant names Pepper, your job is to answer users' questions in short."
-        }]
+        self.history.reset()
+
+    def summarize(self, summary, messages):
+        conversation = '\n'.join(m['role'] + ': ' + m['content'] for m in messages)
+        if summary:
+            conversation = 'Earlier summary: ' + summary + '\n' + conversation
+
+        return chat_completion(
+            self.server_url,
+            [
+                {'role': 'system', 'content': 'Summarize the conversation in a few sentences, keep what the user told about themselves.'},
+                {'role': 'user', 'content': conversation}
+            ],
+            route=self.base_route,
+            model_name=self.model_name,
+            api_key=self.api_key
+        )
+
+    def prime(self):
+        """Sends the system prompt alone, so the server has it processed and cached before the first question"""
+        return chat_completion(
+            self.server_url,
+            self.history.messages()[:1],
+            max_tokens=1,
+            route=self.base_route,
+            model_name=self.model_name,
+            api_key=self.api_key,
+            timeout=self.turn_deadline or None
+        )
+
+    def probe(self):
+        return bool(self.prime())
 
     def start( self ):
         self.memory.subscribeToEvent("SpeechRecognition", self.getName(), "processRemote")
+        self.memory.subscribeToEvent("SpeculativeRecognition", self.getName(), "speculate")
+        self.memory.subscribeToEvent("SpeculationConfirmed", self.getName(), "confirm_speculation")
+        self.memory.subscribeToEvent("SpeculationCancelled", self.getName(), "cancel_speculation")
         # print( "INF: ReceiverModule: started!" )
 
 
     def stop( self ):
         print( "INF: ReceiverModule: stopping..." )
+        self.turns.stop()
+        if self.cache:
+            self.cache.save(force=True)
+        if self.dialogue_log:
+            self.dialogue_log.close()
         try:
             self.memory.unsubscribe('SpeechRecognition', self.getName())
+            self.memory.unsubscribe('SpeculativeRecognition', self.getName())
+            self.memory.unsubscribe('SpeculationConfirmed', self.getName())
+            self.memory.unsubscribe('SpeculationCancelled', self.getName())
         finally:
             print( "INF: ReceiverModule: stopped!" )
 
@@ -69,30 +169,303 @@ class BaseSpeechReceiverModule(ALModule):
 
     def processRemote(self, signalName, message):
         # Do something with the received speech recognition result
+        turn = metrics.claim(message)
+        self.turns.submit((message, turn, Cancellable(), None))
 
-        if not self.response_finished: return
-        self.response_finished = False
+    def speculate(self, signalName, value):
+        # answer the question right away, it's only spoken once the user is really done speaking
+        speculation_id, message = value
+        turn = metrics.claim(message)
+        job = (message, turn, Cancellable(), threading.Event())
 
-        self.messages.append({'role':'user', 'content': message})
-        resp_text = chat_completion(
-            self.server_url, 
-            self.messages, 
-            route=self.base_route, 
-            model_name=self.model_name, 
-            api_key=self.api_key
-        )
+        with self.speaking_lock:
+            outcome = self.speculations.pop(speculation_id, None)
+            if outcome is None:
+                self.speculations[speculation_id] = job
+
+        if outcome is False:
+            metrics.finish(turn, 'cancelled')
+            return
+        if outcome is True:
+            job[3].set()
+        self.turns.submit(job)
+
+    def confirm_speculation(self, signalName, speculation_id):
+        with self.speaking_lock:
+            job = self.speculations.pop(speculation_id, True)
+            if job is True:
+                self.speculations[speculation_id] = True
+                return
+        job[3].set()
+
+    def cancel_speculation(self, signalName, speculation_id):
+        with self.speaking_lock:
+            job = self.speculations.pop(speculation_id, False)
+            if job is False:
+                self.speculations[speculation_id] = False
+                return
+        job[2].cancel()
+        job[3].set()
+
+    def is_busy(self):
+        stats = self.turns.stats()
+        return stats['busy'] or stats['pending'] > 0
+
+    def cancel_turn(self, job):
+        # a superseded turn is only cancelled until the robot starts answering it
+        _, _, cancel, _ = job
+        with self.speaking_lock:
+            if self.speaking is not cancel:
+                cancel.cancel()
+
+    def discard_turn(self, job, reason):
+        _, turn, _, _ = job
+        metrics.finish(turn, reason)
+
+    def start_speaking(self, cancel, speculation=None):
+        # a speculative answer waits for the user to be done speaking
+        if speculation is not None and not speculation.wait(SPECULATION_TIMEOUT):
+            cancel.cancel()
+
+        with self.speaking_lock:
+            if cancel.cancelled:
+                return False
+            self.speaking = cancel
+            return True
+
+    def stop_speaking(self):
+        with self.speaking_lock:
+            self.speaking = None
+
+    # runs on the turn scheduler thread
+    def answer(self, job):
+        message, turn, cancel, speculation = job
+
+        if speculation is None:
+            self.history.add('user', message)
+            messages = self.history.messages()
+        else:
+            # not part of the conversation until it's confirmed
+            messages = self.history.messages() + [{'role': 'user', 'content': message}]
+
+        size, tokens = self.history.payload_size(messages)
+        print("INF: Chat request: %d messages, %d bytes, ~%d tokens" % (len(messages), size, tokens))
+
+        # previous messages the cached answer depends on, besides the question itself
+        context = messages[-1 - self.cache_context:-1] if self.cache_context else []
+        cached = self.cache.get(message, context) if self.cache else None
+        similar = self.similarity_index.query(message) if self.similarity_index and not cached else None
+        requested = not (cached or similar) and self.breaker.allow()
+        complete = not requested    # whether the whole answer arrived
+        expired = threading.Event() # set when no token came before the deadline, the request got cancelled
+
+        if cached:
+            resp_text = cached
+            print("INF: Response cache hit")
+            turn.tags.add('cache')
+            self.speak(resp_text, turn, cancel, speculation)
+        elif similar:
+            resp_text, score, question = similar
+            print("INF: Similar question found (%.2f): %s" % (score, question))
+            turn.tags.add('similar')
+            self.speak(resp_text, turn, cancel, speculation)
+        elif not requested:
+            print("INF: Chat completion unavailable, not waiting for it")
+            resp_text = ''
+        elif self.stream:
+            filler = self.start_filler(turn, cancel, speculation)
+            deadline = self.start_deadline(turn, cancel, expired)
+            resp_text, complete = self.speak_stream(messages, turn, cancel, speculation, filler)
+            self.stop_filler(filler)
+            if deadline:
+                deadline.cancel()
+        else:
+            filler = self.start_filler(turn, cancel, speculation)
+            deadline = self.start_deadline(turn, cancel, expired)
+            resp_text = chat_completion(
+                self.server_url, 
+                messages, 
+                route=self.base_route, 
+                model_name=self.model_name, 
+                api_key=self.api_key,
+                timeout=self.turn_deadline or None,
+                cancel=cancel
+            )
+            complete = bool(resp_text)
+            if complete:
+                turn.mark('llm_last_byte')
+            if deadline:
+                deadline.cancel()
+            self.stop_filler(filler)
+            self.speak(resp_text, turn, cancel, speculation)
+
+        # a request cancelled by the deadline failed, one cancelled by a newer question doesn't tell anything
+        superseded = cancel.cancelled and not expired.is_set()
+        if requested and not superseded:
+            self.breaker.record(complete)
+        if not complete and resp_text:
+            # cut off while streaming, the part already said isn't kept as the answer
+            turn.tags.add('interrupted')
+
+        fallback = not resp_text and not superseded and self.fallback_reply
+        if fallback:
+            # failed, too late or the service is down, saying something beats standing silent
+            metrics.increment('llm_fallbacks')
+            turn.tags.add('fallback')
+            self.speak(self.fallback_reply, turn, Cancellable() if expired.is_set() else cancel, speculation)
+
+        if speculation is not None and not speculation.wait(SPECULATION_TIMEOUT):
+            cancel.cancel()
+            superseded = True
+
+        if superseded and 'tts_start' not in turn.timestamps:
+            # superseded by a newer question or the user went on speaking, nobody waits for this answer
+            print("INF: Turn cancelled: %s" % message)
+            metrics.finish(turn, 'cancelled')
+            return
+
+        if speculation is not None:
+            self.history.add('user', message)
+
+        if resp_text and complete and not (cached or similar):
+            if self.cache:
+                self.cache.put(message, context, resp_text)
+            if self.similarity_learn:
+                self.similarity_index.add(message, resp_text)
 
         if resp_text:
+            if complete:
+                self.history.add('assistant', resp_text)
+
+            if self.dialogue_log:
+                self.dialogue_log.log_turn(turn, message, resp_text)
+
+        # summarize evicted messages after speaking, so it doesn't delay the response
+        self.history.compact()
+        if self.cache:
+            self.cache.save()
+
+        metrics.finish(turn, None if resp_text or fallback else 'no_response')
+
+    def speak(self, resp_text, turn, cancel, speculation=None):
+        if resp_text and self.start_speaking(cancel, speculation):
             print("AI Inference Result:\n================================\n"+resp_text+"\n================================\n")
             self.memory.raiseEvent("Speaking", resp_text)
+            turn.mark('tts_start')
             self.speech.say(resp_text)
+            turn.mark('tts_end')
+            self.memory.raiseEvent("Speaking", None)
+            self.stop_speaking()
+
+    def start_deadline(self, turn, cancel, expired):
+        # cancels the request when no token arrived within turn_deadline seconds, however slowly bytes trickle in
+        if not self.turn_deadline:
+            return None
+        deadline = threading.Timer(self.turn_deadline, self.miss_deadline, [turn, cancel, expired])
+        deadline.daemon = True
+        deadline.start()
+        return deadline
+
+    def miss_deadline(self, turn, cancel, expired):
+        if 'llm_first_byte' in turn.timestamps or 'llm_last_byte' in turn.timestamps or cancel.cancelled:
+            return
+        print("INF: No answer after %.1fs, giving up" % self.turn_deadline)
+        metrics.increment('llm_deadline_exceeded')
+        expired.set()
+        cancel.cancel()
+
+    def start_filler(self, turn, cancel, speculation=None):
+        # says one of the fillers when the chat completion takes longer than filler_delay, stop_filler() ends it
+        if not (self.filler_delay and self.fillers):
+            return None
+        filler = threading.Timer(self.filler_delay, self.say_filler, [turn, cancel, speculation])
+        filler.daemon = True
+        filler.start()
+        return filler
+
+    def say_filler(self, turn, cancel, speculation):
+        # a speculative turn isn't answered yet while the user may still be speaking
+        if speculation is not None and not speculation.is_set():
+            return
+        if 'llm_first_byte' in turn.timestamps or 'llm_last_byte' in turn.timestamps:
+            return
+        if not self.start_speaking(cancel):
+            return
+        filler = random.choice(self.fillers)
+        print("INF: Chat completion is late, saying: %s" % filler)
+        metrics.increment('llm_fillers')
+        turn.tags.add('filler')
+        turn.mark('filler')
+        self.memory.raiseEvent("Speaking", filler)
+        self.speech.say(filler)
+        self.memory.raiseEvent("Speaking", None)
+        self.stop_speaking()
+
+    def stop_filler(self, filler):
+        # the answer is only spoken once the filler is done
+        if filler:
+            filler.cancel()
+            filler.join()
+
+    def speak_stream(self, messages, turn, cancel, speculation=None, filler=None):
+        # speak each sentence as soon as it's generated, while the rest of the response is still streaming
+        pieces = []
+        speaking = False
+        sentences = Queue.Queue()
+        speaker = threading.Thread(target=self.speak_sentences, args=(sentences, ))
+
+        stream = chat_completion_stream(
+            self.server_url,
+            messages,
+            route=self.base_route,
+            model_name=self.model_name,
+            api_key=self.api_key,
+            timeout=self.turn_deadline or None,
+            cancel=cancel
+        )
+
+        def collect():
+            for piece in stream:
+                if not pieces:
+                    turn.mark('llm_first_byte')
+                pieces.append(piece)
+                yield piece
+            turn.mark('llm_last_byte')
+
+        complete = True
+        try:
+            for sentence in split_sentences(collect()):
+                # NAOqi expects utf-8 encoded strings
+                sentence = sentence.encode('utf-8')
+                if not speaking:
+                    self.stop_filler(filler)
+                    if not self.start_speaking(cancel, speculation):
+                        break
+                    speaking = True
+                    self.memory.raiseEvent("Speaking", sentence)
+                    turn.mark('tts_start')
+                    speaker.start()
+                sentences.put(sentence)
+        except StreamInterrupted:
+            # an error, a stall or the deadline, what was already said can't be taken back
+            complete = False
+
+        resp_text = ''.join(pieces).strip().encode('utf-8')
+
+        if speaking:
+            sentences.put(None)
+            speaker.join()
+            turn.mark('tts_end')
             self.memory.raiseEvent("Speaking", None)
-            self.messages.append({'role':'assistant','content':resp_text})
+            self.stop_speaking()
+
+        if resp_text and speaking:
+            print("AI Inference Result:\n================================\n"+resp_text+"\n================================\n")
 
-            if self.save_csv:
-                with open('dialogue.csv', 'a') as f:
-                    f.write('user,"'+message.replace('"', '\\"')+'"\n')
-                    f.write('assistant,"'+resp_text.replace('"', '\\"')+'"\n')
-                    f.close()
+        return resp_text, complete
 
-        self.response_finished = True
+    def speak_sentences(self, sentences):
+        sentence = sentences.get()
+        while sentence is not None:
+            self.speech.say(sentence)
+            sentence = sentences.get()
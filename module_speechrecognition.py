@@ -14,13 +14,17 @@
 #
 ###########################################################
 import socket
+import itertools
+import threading
 
 import numpy as np
 import sys
-import threading
 from naoqi import ALModule, ALProxy
-from tools import audio_recoginze, buffer_to_wav_in_memory
-from numpy import sqrt, mean, square
+from tools import buffer_to_wav_in_memory, merge_transcripts, AudioUpload, Debounce
+from endpoints import SpeechRecognizer
+from audio import RingBuffer, FrameAnalyzer, FrameQueue, NoiseFloor, quietest_point, resample
+from workers import OrderedWorkerPool
+from metrics import metrics
 import traceback
 
 
@@ -30,12 +34,88 @@ IDLE_RELEASE_TIME = 2.0     # seconds, for auto-detect mode: idle time (RMS belo
 HOLD_TIME = 2.0             # seconds, minimum recording time after we started recording (autodetection)
 SAMPLE_RATE = 48000         # Hz, be careful changing this, both google and Naoqi have requirements!
 
-CALIBRATION_DURATION = 4    # seconds, timespan during which calibration is performed (summing up RMS values and calculating mean)
-CALIBRATION_THRESHOLD_FACTOR = 1.5  # factor the calculated mean RMS gets multiplied by to determine the auto detection threshold (after calibration)
+# ALAudioDevice channel flags
+ALL_CHANNELS = 0
+FRONT_CHANNEL = 3
+
+# name: (channel flag, capture rate, upload rate), NAOqi only supports 16kHz when capturing a single channel
+# only the front mic is used either way, audio is resampled to the upload rate before it's sent to speech recognition
+CAPTURE_PROFILES = {
+    'all-48k': (ALL_CHANNELS, 48000, 48000),
+    'front-48k': (ALL_CHANNELS, 48000, 16000),
+    'front-16k': (FRONT_CHANNEL, 16000, 16000),
+}
+DEFAULT_CAPTURE_PROFILE = 'all-48k'
+
+# adaptive threshold: the noise floor is a low percentile of the levels of the last CALIBRATION_DURATION seconds,
+# recording starts above noise floor * start factor and goes on while above noise floor * stop factor
+CALIBRATION_DURATION = 4    # seconds, window of the noise floor estimate, also the time until it's calibrated
+CALIBRATION_THRESHOLD_FACTOR = 1.5  # factor the noise floor gets multiplied by to determine the auto detection (start) threshold
+CALIBRATION_STOP_FACTOR = 1.2       # factor for the stop threshold, lower than the start factor for hysteresis
+NOISE_FLOOR_PERCENTILE = 20
+NOISE_FLOOR_TIME_CONSTANT = 10.0    # seconds, smoothing of the noise floor
 
 DEFAULT_LANGUAGE = "en-us"  # RFC5646 language tag, e.g. "en-us", "de-de", "fr-fr",... <http://stackoverflow.com/a/14302134>
 
-PREBUFFER_WHEN_STOP = False # Fills pre-buffer with last samples when stopping recording. WARNING: has performance issues!
+PREBUFFER_WHEN_STOP = True  # Fills pre-buffer with last samples when stopping recording
+
+RECOGNITION_WORKERS = 2     # number of threads doing the http calls to the speech recognition service
+RECOGNITION_QUEUE_SIZE = 4  # maximum recordings waiting for a free worker
+RECOGNITION_QUEUE_POLICY = 'coalesce'   # when the queue is full: 'coalesce' merges audio into the last queued recording (up to RECORDING_DURATION), 'drop-oldest' or 'drop-newest'
+
+FRAME_QUEUE_SIZE = 32       # frames from ALAudioDevice waiting to be processed, ~5 seconds at 48kHz
+
+SPEAKING_RELEASE_TIME = 0.3 # seconds, frames are still dropped this long after the robot stopped speaking (echo, pauses between sentences)
+
+SPECULATIVE_RELEASE_TIME = 0    # seconds, idle time after which recognition and chat completion start speculatively, 0 disables
+
+# recordings longer than the maximum recording duration are recognized in segments while recording goes on
+SPLIT_SEARCH_DURATION = 1.0 # seconds, the quietest point of the last second of a segment is where it's split
+SPLIT_WINDOW = 0.02         # seconds, resolution of the split point search
+SEGMENT_OVERLAP = 0.3       # seconds, audio around the split point that is part of both segments
+
+
+class Speculation(object):
+    """
+    Recognition of an utterance started before the idle release time is over.
+    It's confirmed when the release time passes without speech, cancelled when the user speaks again,
+    both may happen before or after the recognition result is back.
+    """
+
+    PENDING, RAISED, CONFIRMED, CANCELLED = range(4)
+
+    def __init__(self, speculation_id, turn):
+        self.id = speculation_id
+        self.turn = turn
+        self.state = Speculation.PENDING
+        self.result = None
+        self.done = False
+        self.lock = threading.Lock()
+
+    def recognized(self, result):
+        """Returns the state the result should be handled in"""
+        with self.lock:
+            self.result = result
+            self.done = True
+            if self.state == Speculation.PENDING and result:
+                self.state = Speculation.RAISED
+                return Speculation.PENDING
+            return self.state
+
+    def confirm(self):
+        """
+        Returns RAISED when the receiver is answering it, CONFIRMED when the result isn't back yet
+        (it's handled like any other recording then), PENDING when nothing was recognized
+        """
+        with self.lock:
+            if self.state == Speculation.PENDING and not self.done:
+                self.state = Speculation.CONFIRMED
+            return self.state
+
+    def cancel(self):
+        with self.lock:
+            state, self.state = self.state, Speculation.CANCELLED
+            return state
 
 
 class SpeechRecognitionModule(ALModule):
@@ -55,15 +135,26 @@ class SpeechRecognitionModule(ALModule):
 
             self.port = port
 
+            # stt_url may list several endpoints separated by commas, recordings go to the fastest one
             self.stt_url = stt_url
+            self.recognizer = SpeechRecognizer(stt_url.split(','), stt_route, stt_api_key)
+            metrics.register_gauges('stt_endpoints', self.recognizer.stats)
             self.stt_route = stt_route
             self.stt_api_key = stt_api_key
 
             # self.inited = False
             self.isStarted = False
 
+            # one subscription to ALAudioDevice is kept, pausing only gates the processing of frames
+            # subscribing again on every eye contact and speaking change is slow and loses the lookahead
+            self.audio = ALProxy("ALAudioDevice")
+            self.isSubscribed = False
+            self.gatedFrames = 0
+
             self.eye_contact = False
             self.is_speaking = False
+            self.speaking = Debounce(self.speaking_changed, 0, SPEAKING_RELEASE_TIME)
+            metrics.register_gauges('audio_gate', self.getGateStats)
 
             self.memory = ALProxy("ALMemory", self.strNaoIp, self.port)
             self.memory.subscribeToEvent("EyeContact", self.getName(), "eye_contact_toggle")
@@ -73,30 +164,69 @@ class SpeechRecognitionModule(ALModule):
             self.isRecording = False
             self.startRecordingTimestamp = 0
             self.recordingDuration = RECORDING_DURATION
+            self.segments = 0   # segments of the current recording already sent to recognition
+
+            # upload audio to speech recognition while still recording
+            self.isStreamingEnabled = False
+            self.upload = None
 
             # flag to indicate if auto speech detection is enabled
             self.isAutoDetectionEnabled = False
-            self.autoDetectionThreshold = 10 # TODO: find a default value that works fine so we don't need to calibrate every time
+            self.autoDetectionThreshold = 10 # minimum start threshold when the threshold is adaptive
+
+            # adaptive threshold, follows the background noise when enabled
+            self.isAdaptiveThresholdEnabled = False
+            self.noiseFloor = NoiseFloor(CALIBRATION_DURATION, NOISE_FLOOR_PERCENTILE, NOISE_FLOOR_TIME_CONSTANT)
+            self.startFactor = CALIBRATION_THRESHOLD_FACTOR
+            self.stopFactor = CALIBRATION_STOP_FACTOR
 
             # RMS calculation variables
-            self.framesCount = 0
-            self.rmsSum = 0 # used to sum up rms results and calculate average
             self.lastTimeRMSPeak = 0
-
-            # audio buffer
-            self.buffer = []
-            self.preBuffer = []
-            self.preBufferLength = 0    # length in samples (len(self.preBuffer) just counts entries)
+            self.level = 0
+            self.frameAnalyzer = FrameAnalyzer()
 
             # init parameters
             self.language = DEFAULT_LANGUAGE
             self.idleReleaseTime = IDLE_RELEASE_TIME
             self.holdTime = HOLD_TIME
-            self.lookaheadBufferSize = LOOKAHEAD_DURATION * SAMPLE_RATE
+            self.channelFlag, self.sampleRate, self.uploadRate = CAPTURE_PROFILES[DEFAULT_CAPTURE_PROFILE]
+            self.lookaheadDuration = LOOKAHEAD_DURATION
+            self.lookaheadBufferSize = int(LOOKAHEAD_DURATION * self.sampleRate)
+
+            # audio buffer of the front mic, holds the lookahead samples while idle
+            # and the whole utterance (lookahead included) while recording
+            self.audioBuffer = RingBuffer(self.calcAudioBufferSize())
 
             # counter for wav file output
             self.fileCounter = 0
 
+            # recognitions run on worker threads, results are raised in the order recordings were made
+            self.recognitionPool = None
+            self.setRecognitionQueue(RECOGNITION_WORKERS, RECOGNITION_QUEUE_SIZE, RECOGNITION_QUEUE_POLICY)
+            metrics.register_gauges('recognition', self.getRecognitionStats)
+            metrics.register_gauges('audio_level', self.getAudioLevels)
+
+            # latency metrics of the utterance being recorded
+            self.turn = None
+
+            # speculative recognition of the utterance being recorded
+            self.speculativeReleaseTime = SPECULATIVE_RELEASE_TIME
+            self.speculation = None
+            self.speculationIds = itertools.count(1)
+
+            # transcript of the segments of a long recording recognized so far, only used in onRecognized
+            self.partialTurn = None
+            self.partialText = ''
+
+            # the NAOqi callback only queues frames, analysis and endpointing run on their own thread
+            # so a slow frame never delays the next audio delivery
+            self.frameQueue = FrameQueue(FRAME_QUEUE_SIZE)
+            metrics.register_gauges('audio_frames', self.frameQueue.stats)
+            self.isProcessing = True
+            self.processingThread = threading.Thread(target=self.processFrames, name='SpeechRecognition-frames')
+            self.processingThread.daemon = True
+            self.processingThread.start()
+
         except BaseException as err:
             print( "ERR: SpeechRecognitionModule: loading error: %s" % str(err) )
 
@@ -106,32 +236,40 @@ class SpeechRecognitionModule(ALModule):
         self.stop()
 
     def start( self ):
-        if(self.isStarted):
-            return
-
         # print("INF: SpeechRecognitionModule: starting!")
-
+        self.subscribe()
         self.isStarted = True
 
-        audio = ALProxy( "ALAudioDevice")
-        nNbrChannelFlag = 0 # ALL_Channels: 0,  AL::LEFTCHANNEL: 1, AL::RIGHTCHANNEL: 2 AL::FRONTCHANNEL: 3  or AL::REARCHANNEL: 4.
-        nDeinterleave = 0
-        audio.setClientPreferences( self.getName(),  SAMPLE_RATE, nNbrChannelFlag, nDeinterleave ) # setting same as default generate a bug !?!
-        audio.subscribe( self.getName() )
-
     def pause(self):
-        if not self.isStarted:
+        # frames keep arriving, they only fill the lookahead until started again
+        self.isStarted = False
+
+        # print("INF: SpeechRecognitionModule: stopped!")
+
+    def subscribe(self):
+        if self.isSubscribed:
             return
 
-        self.isStarted = False
+        self.isSubscribed = True
+        nNbrChannelFlag = self.channelFlag # ALL_Channels: 0,  AL::LEFTCHANNEL: 1, AL::RIGHTCHANNEL: 2 AL::FRONTCHANNEL: 3  or AL::REARCHANNEL: 4.
+        nDeinterleave = 0
+        self.audio.setClientPreferences( self.getName(),  self.sampleRate, nNbrChannelFlag, nDeinterleave ) # setting same as default generate a bug !?!
+        self.audio.subscribe( self.getName() )
 
-        audio = ALProxy("ALAudioDevice")
-        audio.unsubscribe(self.getName())
+    def unsubscribe(self):
+        if not self.isSubscribed:
+            return
 
-        # print("INF: SpeechRecognitionModule: stopped!")
+        self.isSubscribed = False
+        self.audio.unsubscribe(self.getName())
 
     def stop( self ):
         self.pause()
+        self.unsubscribe()
+        self.isProcessing = False
+        self.frameQueue.wake()
+        self.processingThread.join(1)
+        self.recognitionPool.stop()
         print( "INF: SpeechRecognitionModule: stopped!" )
 
     def eye_contact_toggle(self, _, has_eye_contact):
@@ -139,7 +277,11 @@ class SpeechRecognitionModule(ALModule):
         self.toggle_status()
 
     def speaking_toggle(self, _, is_speaking):
-        self.is_speaking = not not is_speaking
+        # the robot speaking is noticed right away, the end only after the release time
+        self.speaking.set(is_speaking)
+
+    def speaking_changed(self, is_speaking):
+        self.is_speaking = is_speaking
         self.toggle_status()
 
     def toggle_status(self):
@@ -151,40 +293,78 @@ class SpeechRecognitionModule(ALModule):
     def processRemote( self, nbOfChannels, nbrOfSamplesByChannel, aTimeStamp, buffer ):
         #print("INF: SpeechRecognitionModule: Processing '%s' channels" % nbOfChannels)
 
-        # calculate a decimal seconds timestamp
-        timestamp = float (str(aTimeStamp[0]) + "."  + str(aTimeStamp[1]))
+        # the robot's own voice is neither recorded nor kept as lookahead
+        if self.is_speaking:
+            self.gatedFrames += 1
+            return
+
+        # calculate a decimal seconds timestamp, NAOqi gives [seconds, microseconds]
+        # the frame is copied, NAOqi reuses the buffer after the callback returns
+        self.frameQueue.put(buffer, nbOfChannels, aTimeStamp[0] + aTimeStamp[1] / 1000000.0)
 
+    # processRemote - end
+
+    def processFrames(self):
+        while self.isProcessing:
+            frame = self.frameQueue.peek()
+            if frame is None:
+                continue
+            try:
+                self.processFrame(*frame)
+            finally:
+                self.frameQueue.release()
+
+    def processFrame(self, samples, nbOfChannels, timestamp):
         # put whole function in a try/except to be able to see the stracktrace
         try:
 
-            aSoundDataInterlaced = np.fromstring( str(buffer), dtype=np.int16 )
-            aSoundData = np.reshape( aSoundDataInterlaced, (nbOfChannels, nbrOfSamplesByChannel), 'F' )
+            # view of the front mic samples, first of the interleaved channels
+            # or the only one when capturing a single channel
+            aSoundDataFront = samples[::nbOfChannels]
+
+            if not (self.isStarted or self.isRecording):
+                # paused, keep the lookahead only, so speech starting right when it's started again isn't cut
+                self.audioBuffer.write(aSoundDataFront)
+                self.audioBuffer.keep_last(self.lookaheadBufferSize)
+                return
 
             # compute RMS, handle autodetection
             if( self.isAutoDetectionEnabled or self.isRecording):
 
                 # compute the rms level on front mic
-                rmsMicFront = self.calcRMSLevel(self.convertStr2SignedInt(aSoundData[0]))
+                rmsMicFront = self.frameAnalyzer.analyze(aSoundDataFront)
+                self.level = rmsMicFront
+                self.updateNoiseFloor(rmsMicFront, len(aSoundDataFront) / float(self.sampleRate), timestamp)
 
-                if (rmsMicFront >= self.autoDetectionThreshold):
+                # once recording, the lower stop threshold applies, so quiet syllables don't end the utterance
+                startThreshold, stopThreshold = self.getThresholds()
+
+                if (rmsMicFront >= (stopThreshold if self.isRecording else startThreshold)):
                     # save timestamp when we last had and RMS > threshold
                     self.lastTimeRMSPeak = timestamp
 
+                    # the user goes on speaking, the speculation was too early
+                    if self.speculation:
+                        self.cancelSpeculation()
+
                     # start recording if we are not doing so already
                     if (self.isAutoDetectionEnabled and self.eye_contact and not self.isRecording):
                         self.startRecording()
 
+            # write front mic samples to buffer, used as lookahead when not recording
+            self.audioBuffer.write(aSoundDataFront)
+
             if(self.isRecording):
-                # write to buffer
-                self.buffer.append(aSoundData)
+                if self.upload:
+                    # copy, the queue reuses the slot once the frame is processed
+                    self.upload.send(aSoundDataFront.copy())
 
                 if (self.startRecordingTimestamp <= 0):
                     # initialize timestamp when we start recording
                     self.startRecordingTimestamp = timestamp
-                # elif ((timestamp - self.startRecordingTimestamp) > self.recordingDuration):
-                #     # print('stop after max recording duration')
-                #     # check how long we are recording
-                #     self.stopRecordingAndRecognize()
+                elif len(self.audioBuffer) >= self.recordingDuration * self.sampleRate:
+                    # too long for one request, recognize what we have while recording goes on
+                    self.splitRecording()
 
                 # stop recording after idle time (and recording at least hold time)
                 # lastTimeRMSPeak is 0 if no peak occured
@@ -192,29 +372,19 @@ class SpeechRecognitionModule(ALModule):
                         timestamp - self.startRecordingTimestamp >= self.holdTime):
                     # print(('stopping after idle/hold time'))
                     self.stopRecordingAndRecognize()
+                elif self.speculativeReleaseTime and not self.speculation and not self.segments and (
+                        timestamp - self.lastTimeRMSPeak >= self.speculativeReleaseTime) and (
+                        timestamp - self.startRecordingTimestamp >= self.holdTime):
+                    self.speculate()
             else:
-                # constantly record into prebuffer for lookahead
-                self.preBuffer.append(aSoundData)
-                self.preBufferLength += len(aSoundData[0])
-
-                # remove first (oldest) item if the buffer gets bigger than required
-                # removes one block of samples as we store a list of lists...
-                overshoot = (self.preBufferLength - self.lookaheadBufferSize)
-
-                if((overshoot > 0) and (len(self.preBuffer) > 0)):
-                    self.preBufferLength -= len(self.preBuffer.pop(0)[0])
+                # only keep the last samples for lookahead
+                self.audioBuffer.keep_last(self.lookaheadBufferSize)
 
         except:
             # i did this so i could see the stracktrace as the thread otherwise just silently failed
             traceback.print_exc()
 
-    # processRemote - end
-
-    def calcRMSLevel(self, data):
-        rms = (sqrt(mean(square(data))))
-        # TODO: maybe a log would be better for threshold?
-        #rms = 20 * np.log10(np.sqrt(np.sum(np.power(data, 2) / len(data))))
-        return rms
+    # processFrame - end
 
     def version( self ):
         return "1.1"
@@ -233,14 +403,43 @@ class SpeechRecognitionModule(ALModule):
         # start recording
         self.startRecordingTimestamp = 0
         self.lastTimeRMSPeak = 0
-        self.buffer = self.preBuffer
+        self.segments = 0
+        self.turn = metrics.start_turn()
 
-        #self.preBuffer = []
+        # samples already in audio buffer are the lookahead of this recording
+        self.startUpload()
 
         self.isRecording = True
 
         return
 
+    def startUpload(self):
+        if self.isStreamingEnabled:
+            self.upload = AudioUpload(self.recognizer.best().url, self.stt_route, self.stt_api_key, self.sampleRate, self.uploadRate)
+            self.upload.send(self.audioBuffer.read())
+
+    def splitRecording(self):
+        samples = self.audioBuffer.read()
+
+        # split at the quietest point near the end, both segments get the audio around it
+        # so a word cut there is still whole in one of them
+        search = min(int(SPLIT_SEARCH_DURATION * self.sampleRate), len(samples))
+        overlap = int(SEGMENT_OVERLAP * self.sampleRate) // 2
+        split = len(samples) - search + quietest_point(samples[-search:], max(int(SPLIT_WINDOW * self.sampleRate), 1))
+        self.audioBuffer.keep_last(len(samples) - max(split - overlap, 0))
+
+        # a streamed upload already sent everything up to now, it overlaps the next one a bit more
+        if self.upload:
+            self.upload.finish()
+
+        self.segments += 1
+        self.turn.tags.add('segmented')
+        metrics.increment('recording_segments')
+        self.recognitionPool.submit((samples[:split + overlap], self.upload, self.turn, None, True))
+
+        self.upload = None
+        self.startUpload()
+
     def stopRecordingAndRecognize(self):
         if(self.isRecording == False):
             # print("INF: SpeechRecognitionModule.stopRecordingAndRecognize: not recording")
@@ -251,35 +450,32 @@ class SpeechRecognitionModule(ALModule):
         # TODO: choose which mic channel to use
         # can we use the sound direction module for this?
 
-        # buffer is a list of nparrays we now concat into one array
-        # and the slice out the first mic channel
-        slice = np.concatenate(self.buffer, axis=1)[0]
-
-        # initialize preBuffer with last samples to fix cut off words
-        # loop through buffer and count samples until prebuffer is full
-        # TODO: performance issues!
-        if (PREBUFFER_WHEN_STOP):
-            sampleCounter = 0
-            itemCounter = 0
-
-            for i in reversed(self.preBuffer):
-                sampleCounter += len(i[0])
-
-                if(sampleCounter > self.lookaheadBufferSize):
-                    break
+        # read returns a copy of the front mic samples, so it's thread safe
+        slice = self.audioBuffer.read()
 
-                itemCounter += 1
+        if self.speculation:
+            # nothing was said since the speculation started, it already has the whole utterance
+            self.confirmSpeculation()
+            slice = None
 
-            start = len(self.buffer) - itemCounter
-            self.preBuffer = self.buffer[start:]
+        # initialize lookahead with last samples to fix cut off words
+        if (PREBUFFER_WHEN_STOP):
+            self.audioBuffer.keep_last(self.lookaheadBufferSize)
         else:
-            # don't copy to prebuffer
-            self.preBuffer = []
+            self.audioBuffer.clear()
 
-        # start new worker thread to do the http call and some processing
-        # copy slice to be thread safe!
-        # TODO: make a job queue so we don't start a new thread for each recognition
-        threading.Thread(target=self.recognize, args=(slice.copy(), )).start()
+        # queue for a worker thread to do the http call and some processing
+        # the whole recording is kept in case the streaming upload fails
+        if slice is None:
+            if self.upload:
+                self.upload.cancel()
+        else:
+            self.turn.mark('endpoint')
+            if self.upload:
+                self.upload.finish()
+            self.recognitionPool.submit((slice, self.upload, self.turn, None, False))
+        self.upload = None
+        self.turn = None
 
         # reset flag
         self.isRecording = False
@@ -294,46 +490,219 @@ class SpeechRecognitionModule(ALModule):
         self.isAutoDetectionEnabled = False
         return
 
+    def enableStreamingRecognition(self):
+        self.isStreamingEnabled = True
+
+    def disableStreamingRecognition(self):
+        self.isStreamingEnabled = False
+
     def setLanguage(self, language = DEFAULT_LANGUAGE):
         self.language = language
         return
 
-    # used for RMS calculation
-    def convertStr2SignedInt(self, data):
-        """
-        This function takes a string containing 16 bits little endian sound
-        samples as input and returns a vector containing the 16 bits sound
-        samples values converted between -1 and 1.
-        """
-
-        # from the naoqi sample, but rewritten to use numpy methods instead of for loops
+    def speculate(self):
+        # recognize and answer what was said so far, while waiting whether the user goes on speaking
+        turn = metrics.start_turn(self.turn.timestamps.get('onset'))
+        turn.mark('endpoint')
+        turn.tags.add('speculative')
+        self.speculation = Speculation(next(self.speculationIds), turn)
+        metrics.increment('speculations')
+        self.recognitionPool.submit((self.audioBuffer.read(), None, turn, self.speculation, False))
+
+    def cancelSpeculation(self):
+        speculation, self.speculation = self.speculation, None
+        metrics.increment('speculations_cancelled')
+        if speculation.cancel() == Speculation.RAISED:
+            # the receiver is already answering it, a wasted chat completion
+            metrics.increment('speculations_wasted')
+            self.memory.raiseEvent("SpeculationCancelled", speculation.id)
+
+    def confirmSpeculation(self):
+        speculation, self.speculation = self.speculation, None
+        metrics.increment('speculations_confirmed')
+
+        state = speculation.confirm()
+        if state == Speculation.RAISED:
+            self.memory.raiseEvent("SpeculationConfirmed", speculation.id)
+        elif state == Speculation.PENDING:
+            # recognized nothing
+            metrics.finish(speculation.turn, 'empty')
+
+    # runs on worker threads
+    def recognize(self, job):
+        data, upload, turn, speculation, partial = job
+
+        if upload:
+            # bounded by the recognition deadline too, a stalled upload would hold up every later result
+            result = upload.wait(self.recognizer.deadline)
+            if result is not None:
+                turn.mark('stt')
+                return result, turn, speculation, partial
+            if upload.expired:
+                metrics.increment('stt_upload_timeouts')
+            # streaming failed, send the whole recording instead
+
+        data = resample(data, self.sampleRate, self.uploadRate)
+        wav_file = buffer_to_wav_in_memory(data, sample_rate=self.uploadRate)
+        turn.mark('encoded')
+
+        result = self.recognizer.recognize(wav_file)
+        turn.mark('stt')
+        return result, turn, speculation, partial
+
+    # called in the same order recordings were queued
+    def onRecognized(self, recognition):
+        if not recognition:
+            return
 
-        lsb = data[0::2]
-        msb = data[1::2]
+        result, turn, speculation, partial = recognition
+
+        if speculation:
+            state = speculation.recognized(result)
+            if state == Speculation.CANCELLED or (state == Speculation.PENDING and not result):
+                return
+            if state == Speculation.PENDING:
+                # answered right away, but only spoken once confirmed
+                metrics.hand_over(turn, result)
+                self.memory.raiseEvent("SpeculativeRecognition", [speculation.id, result])
+                return
+            # confirmed before the result was back, handled like any other recording
+
+        # segments of a long recording, the transcript is raised once the last one is recognized
+        if partial or turn is self.partialTurn:
+            if turn is not self.partialTurn:
+                self.partialText = ''
+            result = merge_transcripts(self.partialText, result or '')
+            if partial:
+                self.partialTurn, self.partialText = turn, result
+                return
+            self.partialTurn, self.partialText = None, ''
+            turn.mark('stt')
+
+        if not result:
+            # None when speech recognition failed on every endpoint
+            metrics.finish(turn, 'empty' if result is not None else 'failed')
+            return
 
-        # don't remove the .0, otherwise overflow!
-        rms_data = np.add(lsb, np.multiply(msb, 256.0))
+        metrics.hand_over(turn, result)
+        self.memory.raiseEvent("SpeechRecognition", result)
+        print('Speech Recognition Result:\n================================\n'+result+'\n================================\n')
+
+    def setRecognitionQueue(self, workers, queueSize, policy):
+        if self.recognitionPool:
+            self.recognitionPool.stop()
+
+        self.recognitionPool = OrderedWorkerPool(
+            self.recognize, self.onRecognized,
+            workers=workers, max_queue=queueSize, policy=policy,
+            coalesce=self.coalesceRecordings,
+            name='SpeechRecognition'
+        )
+
+    def coalesceRecordings(self, queued, job):
+        # speculations are pointless once recognition is that far behind, the recording replaces them
+        if job[3] or queued[3]:
+            speculative, kept = (job, queued) if job[3] else (queued, job)
+            if speculative[3] is self.speculation:
+                self.speculation = None
+            speculative[3].cancel()
+            metrics.increment('speculations_cancelled')
+            return kept
+
+        # segments are stitched by the turn of their recording, only whole recordings are merged with each other
+        if job[2] is not queued[2] and (self.isSegment(queued) or self.isSegment(job)):
+            return None
+
+        data = job[0]
+        if job[2] is queued[2]:
+            # consecutive segments of one recording, the audio both have is only sent once
+            data = data[2 * (int(SEGMENT_OVERLAP * self.sampleRate) // 2):]
+
+        # never longer than a recording is allowed to get, the pool drops the oldest job instead
+        if len(queued[0]) + len(data) > self.recordingDuration * self.sampleRate:
+            return None
+
+        # merged recordings are sent as a whole, streamed uploads can't be merged
+        for _, upload, _, _, _ in (queued, job):
+            if upload:
+                upload.cancel()
+
+        if job[2] is not queued[2]:
+            metrics.finish(job[2], 'coalesced')
+        return (np.concatenate((queued[0], data)), None, queued[2], None, job[4])
+
+    def isSegment(self, job):
+        # partial, or the last segment of a recording that got split
+        return job[4] or 'segmented' in job[2].tags
+
+    def getRecognitionStats(self):
+        return self.recognitionPool.stats()
 
-        # gives and array that contains -65536 on every position where signedData is > 32768
-        sign_correction = np.select([rms_data>=32768], [-65536])
+    def setAutoDetectionThreshold(self, threshold):
+        self.autoDetectionThreshold = threshold
 
-        # add the two to get the correct signed values
-        rms_data = np.add(rms_data, sign_correction)
+    def enableAdaptiveThreshold(self):
+        self.isAdaptiveThresholdEnabled = True
 
-        # normalize values to -1.0 ... +1.0
-        rms_data = np.divide(rms_data, 32768.0)
+    def disableAdaptiveThreshold(self):
+        self.isAdaptiveThresholdEnabled = False
 
-        return rms_data
+    def setAdaptiveThresholdFactors(self, startFactor, stopFactor):
+        if stopFactor > startFactor:
+            raise ValueError("Stop factor has to be lower than the start factor")
+        self.startFactor = startFactor
+        self.stopFactor = stopFactor
 
-    def recognize(self, data):
-        wav_file = buffer_to_wav_in_memory(data, sample_rate=SAMPLE_RATE)
-        result = audio_recoginze(self.stt_url, wav_file, self.stt_route, self.stt_api_key)
-        if result:
-            self.memory.raiseEvent("SpeechRecognition", result)
-            print('Speech Recognition Result:\n================================\n'+result+'\n================================\n')
+    def setCalibrationDuration(self, duration):
+        self.noiseFloor.window = duration
+        self.noiseFloor.reset()
 
-    def setAutoDetectionThreshold(self, threshold):
-        self.autoDetectionThreshold = threshold
+    def updateNoiseFloor(self, level, duration, timestamp):
+        if not self.isAdaptiveThresholdEnabled:
+            return
+        # recordings are mostly speech, but when the noise rose above the threshold everything is a recording,
+        # so those count too once they're longer than the calibration window
+        if not self.isRecording or 0 < self.startRecordingTimestamp < timestamp - self.noiseFloor.window:
+            self.noiseFloor.update(level, duration)
+
+    def getThresholds(self):
+        """Returns (start, stop) thresholds, both are the fixed threshold until the noise floor is calibrated"""
+        if not self.isAdaptiveThresholdEnabled or not self.noiseFloor.calibrated():
+            return self.autoDetectionThreshold, self.autoDetectionThreshold
+        start = max(self.autoDetectionThreshold, self.noiseFloor.floor * self.startFactor)
+        return start, start * self.stopFactor / self.startFactor
+
+    def getAudioLevels(self):
+        start, stop = self.getThresholds()
+        return {
+            'level': self.level,
+            'noise_floor': self.noiseFloor.floor or 0.0,
+            'calibrated': self.noiseFloor.calibrated(),
+            'start_threshold': start,
+            'stop_threshold': stop
+        }
+
+    def getGateStats(self):
+        return {
+            'listening': int(self.isStarted),
+            'subscribed': int(self.isSubscribed),
+            'gated_frames': self.gatedFrames,
+            'speaking_changes': self.speaking.changes,
+            'speaking_ignored': self.speaking.ignored
+        }
+
+    def setRecognitionRetries(self, deadline, retries, backoff):
+        self.recognizer.deadline = deadline
+        self.recognizer.retries = retries
+        self.recognizer.backoff = backoff
+
+    def enableHedging(self, delay):
+        # delay is used until the p95 latency of an endpoint is known
+        self.recognizer.hedge = True
+        self.recognizer.hedge_delay = delay
+
+    def disableHedging(self):
+        self.recognizer.hedge = False
 
     def setIdleReleaseTime(self, releaseTime):
         self.idleReleaseTime = releaseTime
@@ -341,10 +710,36 @@ class SpeechRecognitionModule(ALModule):
     def setHoldTime(self, holdTime):
         self.holdTime = holdTime
 
+    def setSpeakingReleaseTime(self, releaseTime):
+        self.speaking.off_delay = releaseTime
+
+    def setSpeculativeReleaseTime(self, releaseTime):
+        # only has an effect when shorter than the idle release time, 0 disables speculation
+        self.speculativeReleaseTime = releaseTime
+
     def setMaxRecordingDuration(self, duration):
         self.recordingDuration = duration
+        self.audioBuffer.resize(self.calcAudioBufferSize())
 
     def setLookaheadDuration(self, duration):
-        self.lookaheadBufferSize = duration * SAMPLE_RATE
-        self.preBuffer = []
-        self.preBufferLength = 0
+        self.lookaheadDuration = duration
+        self.lookaheadBufferSize = int(duration * self.sampleRate)
+        self.audioBuffer = RingBuffer(self.calcAudioBufferSize())
+
+    def calcAudioBufferSize(self):
+        # lookahead plus maximum recording time, plus a second of frames arriving before a long recording is split
+        return self.lookaheadBufferSize + int((self.recordingDuration + 1) * self.sampleRate)
+
+    def setCaptureProfile(self, profile):
+        if profile not in CAPTURE_PROFILES:
+            raise ValueError("Unknown capture profile: %s" % profile)
+
+        # subscribe again if running, client preferences only apply when subscribing
+        resubscribe = self.isSubscribed
+        self.unsubscribe()
+
+        self.channelFlag, self.sampleRate, self.uploadRate = CAPTURE_PROFILES[profile]
+        self.setLookaheadDuration(self.lookaheadDuration)
+
+        if resubscribe:
+            self.subscribe()
@@ -0,0 +1,327 @@
+import glob
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import types
+import wave
+
+import numpy as np
+
+from audio import resample
+
+# ALAudioDevice buffer size (samples per channel) for each capture rate, ~170ms at 48kHz and ~85ms at 16kHz
+SAMPLES_PER_FRAME = {48000: 8192, 16000: 1365}
+
+FAKE_TTS_WORDS_PER_MINUTE = 150
+
+
+class FakeMemory(object):
+    """In-process ALMemory event bus, callbacks run on their own thread like NAOqi does"""
+
+    def __init__(self, modules):
+        self.modules = modules
+        self.subscribers = {}   # event -> {module name: method name}
+        self.lock = threading.Lock()
+        self.pending = 0        # callbacks still running
+
+    def declareEvent(self, event):
+        self.subscribers.setdefault(event, {})
+
+    def subscribeToEvent(self, event, module_name, method):
+        with self.lock:
+            self.subscribers.setdefault(event, {})[module_name] = method
+
+    def unsubscribeToEvent(self, event, module_name):
+        with self.lock:
+            self.subscribers.get(event, {}).pop(module_name, None)
+
+    unsubscribe = unsubscribeToEvent
+
+    def raiseEvent(self, event, value):
+        with self.lock:
+            callbacks = [getattr(self.modules[name], method) for name, method in self.subscribers.get(event, {}).items()]
+            self.pending += len(callbacks)
+
+        for callback in callbacks:
+            thread = threading.Thread(target=self.dispatch, args=(callback, event, value), name='Event-' + event)
+            thread.daemon = True
+            thread.start()
+
+    def dispatch(self, callback, event, value):
+        # like NAOqi, callbacks may take (), (value) or (event, value)
+        try:
+            count = len(inspect.getargspec(callback).args) - 1
+            callback(*(event, value)[2 - count:])
+        except:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+
+class FakeAudioDevice(object):
+    def __init__(self):
+        self.preferences = {}   # module name -> (sample rate, channel flag)
+        self.subscribed = set()
+        self.calls = 0          # each one is a round trip to NAOqi on the robot
+
+    def setClientPreferences(self, name, sample_rate, channel_flag, deinterleave):
+        self.calls += 1
+        self.preferences[name] = (sample_rate, channel_flag)
+
+    def subscribe(self, name):
+        self.calls += 1
+        self.subscribed.add(name)
+
+    def unsubscribe(self, name):
+        self.calls += 1
+        self.subscribed.discard(name)
+
+
+class FakeTextToSpeech(object):
+    """Takes as long as saying the text would, records when each text was said"""
+
+    def __init__(self, speed=1.0):
+        self.speed = speed
+        self.said = []      # (text, start, end)
+        self.lock = threading.Lock()
+
+    def say(self, text):
+        start = time.time()
+        time.sleep(len(text.split()) * 60.0 / FAKE_TTS_WORDS_PER_MINUTE / self.speed)
+        with self.lock:
+            self.said.append((text, start, time.time()))
+
+
+class FakeTabletService(object):
+    def loadUrl(self, url):
+        pass
+
+    def showWebview(self):
+        pass
+
+
+class FakeNaoqi(object):
+    """Services and modules of the fake broker, ALProxy looks them up by name"""
+
+    def __init__(self):
+        self.modules = {}
+        self.services = {
+            'ALMemory': FakeMemory(self.modules),
+            'ALAudioDevice': FakeAudioDevice(),
+            'ALTextToSpeech': FakeTextToSpeech(),
+            'ALTabletService': FakeTabletService()
+        }
+
+    def proxy(self, name, *args):
+        if name in self.services:
+            return self.services[name]
+        if name in self.modules:
+            return self.modules[name]
+        raise RuntimeError("Can't find service: %s" % name)
+
+    def module(self, naoqi):
+        fake = self
+
+        class ALModule(object):
+            def __init__(self, name):
+                self.__name = name
+                fake.modules[name] = self
+
+            def getName(self):
+                return self.__name
+
+            def BIND_PYTHON(self, *args):
+                pass
+
+        class ALBroker(object):
+            def __init__(self, *args):
+                pass
+
+            def shutdown(self):
+                pass
+
+        naoqi.ALModule = ALModule
+        naoqi.ALBroker = ALBroker
+        naoqi.ALProxy = self.proxy
+        return naoqi
+
+fake = None
+
+def install():
+    """Registers a fake naoqi module, has to be called before any module imports naoqi"""
+    global fake
+    fake = FakeNaoqi()
+    sys.modules['naoqi'] = fake.module(types.ModuleType('naoqi'))
+    return fake
+
+
+def read_wav(path):
+    """Returns the samples of a 16 bit wav file mixed down to mono, and its sample rate"""
+    f = wave.open(path, 'rb')
+    try:
+        if f.getsampwidth() != 2:
+            raise ValueError('%s: only 16 bit wav files are supported' % path)
+        channels, rate = f.getnchannels(), f.getframerate()
+        samples = np.frombuffer(f.readframes(f.getnframes()), dtype='<i2')
+    finally:
+        f.close()
+
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return samples, rate
+
+
+def load_directory(directory):
+    """Yields (name, samples, sample rate, transcript) of the wav files of a directory, transcript is <name>.txt or None"""
+    for path in sorted(glob.glob(os.path.join(directory, '*.wav'))):
+        transcript = None
+        transcript_path = os.path.splitext(path)[0] + '.txt'
+        if os.path.exists(transcript_path):
+            with open(transcript_path, 'r') as f:
+                transcript = f.read().strip()
+        samples, rate = read_wav(path)
+        yield path, samples, rate, transcript
+
+
+class Replay(object):
+    """
+    Feeds utterances into the speech recognition module like ALAudioDevice would,
+    in frames of the negotiated rate and channels with NAOqi timestamps, paced in real time (times speed).
+    After each utterance silence is fed until the whole pipeline is idle again, plus some gap.
+    Transcripts are queued on the stub server when one is used.
+    """
+
+    def __init__(self, speech, speed=1.0, gap=1.0, stub=None):
+        self.speech = speech
+        self.speed = speed
+        self.gap = gap
+        self.stub = stub
+
+        self.memory = fake.services['ALMemory']
+        self.audio = fake.services['ALAudioDevice']
+        self.tts = fake.services['ALTextToSpeech']
+        self.tts.speed = speed
+
+        self.start_time = 0
+        self.utterances = 0
+        self.position = 0       # samples fed so far, at the capture rate
+        self.frames = 0
+        self.delivered = 0
+        self.processed = 0
+        self.process_time = 0.0 # seconds spent in processRemote
+        self.frame_time = 0.0   # seconds spent in processFrame, on the thread behind the module's frame queue
+
+        # processRemote only queues the frame, the actual work is timed where the module does it
+        self.process_frame = speech.processFrame
+        speech.processFrame = self.timed_frame
+
+    def layout(self):
+        rate, channel_flag = self.audio.preferences.get(self.speech.getName(), (self.speech.sampleRate, self.speech.channelFlag))
+        return rate, 4 if channel_flag == 0 else 1
+
+    def frame_size(self, rate):
+        return SAMPLES_PER_FRAME.get(rate, rate // 6)
+
+    def feed(self, samples):
+        rate, channels = self.layout()
+        size = self.frame_size(rate)
+
+        for i in range(0, len(samples), size):
+            frame = samples[i:i + size]
+            if len(frame) < size:
+                frame = np.concatenate((frame, np.zeros(size - len(frame), dtype=np.int16)))
+            self.feed_frame(frame, rate, channels)
+
+    def feed_frame(self, frame, rate, channels):
+        self.position += len(frame)
+        self.frames += 1
+
+        # NAOqi calls back once a buffer is full
+        elapsed = self.position / float(rate)
+        delay = self.start_time + elapsed / self.speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        # frames captured while not subscribed (e.g. robot speaking) are lost, like on the robot
+        if self.speech.getName() not in self.audio.subscribed:
+            return
+
+        timestamp = self.start_time + elapsed
+        buffer = np.repeat(frame, channels).astype('<i2').tobytes()
+
+        start = time.time()
+        self.speech.processRemote(channels, len(frame), [int(timestamp), int(timestamp % 1 * 1000000)], buffer)
+        self.process_time += time.time() - start
+        self.delivered += 1
+
+    def timed_frame(self, *frame):
+        start = time.time()
+        try:
+            return self.process_frame(*frame)
+        finally:
+            self.frame_time += time.time() - start
+            self.processed += 1
+
+    def idle(self):
+        stats = self.speech.getRecognitionStats()
+        if len(self.speech.frameQueue) or self.speech.isRecording or stats['pending'] or self.memory.pending:
+            return False
+        # modules doing work outside of event callbacks, like the receiver answering on its own thread
+        return not any(module.is_busy() for module in fake.modules.values() if hasattr(module, 'is_busy'))
+
+    def silence(self, duration):
+        rate = self.layout()[0]
+        self.feed(np.zeros(max(int(duration * rate), self.frame_size(rate)), dtype=np.int16))
+
+    def settle(self):
+        while not self.idle():
+            self.silence(0)
+        self.silence(self.gap)
+
+    def run(self, utterances):
+        """Replays (name, samples, sample rate, transcript) utterances, returns a report"""
+        # somebody looks at the robot during the whole replay
+        self.memory.raiseEvent('FaceDetected', [1])
+
+        self.start_time = time.time()
+        self.position = 0
+        for name, samples, rate, transcript in utterances:
+            print('INF: Replaying %s' % name)
+            if self.stub and transcript:
+                self.stub.queue_transcript(transcript)
+            self.feed(resample(samples, rate, self.layout()[0]))
+            self.settle()
+            self.utterances += 1
+
+        return self.report()
+
+    def audio_seconds(self):
+        return self.position / float(self.layout()[0])
+
+    def report(self):
+        return {
+            'utterances': self.utterances,
+            'audio_seconds': round(self.audio_seconds(), 3),
+            'wall_seconds': round(time.time() - self.start_time, 3),
+            'frames': self.frames,
+            'frames_delivered': self.delivered,
+            'audio_device_calls': self.audio.calls,
+            'frames_processed': self.processed,
+            'frames_dropped': self.speech.frameQueue.dropped,
+            'frame_queue_high_water': self.speech.frameQueue.high_water,
+            # a frame costs both the callback and its processing
+            'frames_per_second': round(self.processed / (self.process_time + self.frame_time), 1) if self.processed else 0,
+            'said': [
+                {'text': text, 'start': round(start - self.start_time, 3), 'duration': round(end - start, 3)}
+                for text, start, end in self.tts.said
+            ]
+        }
+
+def print_report(report, summary):
+    report['metrics'] = summary
+    print(json.dumps(report, indent=2, sort_keys=True))
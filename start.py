@@ -1,3 +1,10 @@
+import sys
+
+# replaying recordings runs without a robot, the fake naoqi has to be in place before the modules import it
+if any(arg.split('=')[0] == '--replay' for arg in sys.argv):
+    import replay
+    replay.install()
+
 from module_receiver import BaseSpeechReceiverModule
 from module_speechrecognition import SpeechRecognitionModule
 from module_eyecontact import EyeContactModule
@@ -5,10 +12,14 @@ from naoqi import ALProxy, ALBroker
 
 import time
 import os
-import sys
 
 from optparse import OptionParser
-from tools import load_env, toint, tofloat
+from tools import load_env, toint, tofloat, http_pool
+from cache import SimilarityIndex
+from metrics import metrics
+from stubs import StubServer
+from dialogue import DialogueLog
+from warmup import Warmup
 
 load_env()
 
@@ -26,8 +37,11 @@ API_KEY = os.getenv('API_KEY')
 SPEECH_API_KEY = os.getenv('SPEECH_API_KEY') or API_KEY
 
 WEBVIEW = os.getenv('WEBVIEW') or ''
+FAQ_FILE = os.getenv('FAQ_FILE') or ''
+STREAM = bool(toint(os.getenv('STREAM')))
 
 def main():
+    startup = time.time()
     parser = OptionParser()
     parser.add_option("--ip",
         help="Parent broker port. The IP address or your robot",
@@ -64,9 +78,23 @@ def main():
     parser.add_option("--fprompt",
         help="Add a system prompt load from a file, specify the file name to . If --prompt is specified, ignore this",
         dest="fprompt")
+    parser.add_option("--faq",
+        help="Load a json file of frequently asked questions, similar questions are answered without calling the LLM",
+        dest="faq")
+    parser.add_option("--stream",
+        help="Set to stream chat completions and speak each sentence as soon as it's generated",
+        dest="stream",
+        action='store_true')
     parser.add_option("--webview",
         help="Start a webview server when this script starts. Speficy the url of webview.",
         dest="webview")
+    parser.add_option("--replay",
+        help="Run without a robot, feeding the wav files of this directory as microphone audio. Without --url, local stub services answer",
+        dest="replay")
+    parser.add_option("--replay-speed",
+        help="Replay audio this many times faster than real time, default 1.0",
+        dest="replay_speed",
+        type="float")
     parser.set_defaults(
         ip=NAO_IP,
         port=NAO_PORT,
@@ -79,7 +107,11 @@ def main():
         save_csv=False,
         prompt='',
         fprompt='',
-        webview=WEBVIEW
+        stream=STREAM,
+        faq=FAQ_FILE,
+        webview=WEBVIEW,
+        replay='',
+        replay_speed=1.0
     )
 
     opts = parser.parse_args()[0]
@@ -96,10 +128,36 @@ def main():
     prompt=opts.prompt
     fprompt=opts.fprompt
     webview = opts.webview
+    stream = opts.stream
+    faq = opts.faq
+
+    stub = None
+    if opts.replay and not server_url:
+        stub = StubServer(speech_route=speech_route, chat_route=chat_route).start()
+        server_url = stub.url
+        print('INF: Replaying against stub services on %s' % server_url)
 
     if not server_url:
         print('Error: Services route not specified!')
         return
+
+    # keep-alive connections shared by speech recognition and chat completion
+    http_pool.configure(
+        max_size=toint(os.getenv('HTTP_POOL_SIZE')),
+        idle_timeout=tofloat(os.getenv('HTTP_IDLE_TIMEOUT')),
+        connect_timeout=tofloat(os.getenv('HTTP_CONNECT_TIMEOUT')),
+        read_timeout=tofloat(os.getenv('HTTP_READ_TIMEOUT'))
+    )
+
+    speech_recoginition_url = os.getenv('SPEECH_RECOGINITION_URL') or server_url
+
+    # resolve and connect to the services while the modules start
+    warmup = Warmup(
+        [server_url] + speech_recoginition_url.split(','),
+        connections=toint(os.getenv('WARMUP_CONNECTIONS')) or 1,
+        idle_timeout=tofloat(os.getenv('WARMUP_IDLE_TIMEOUT', 600))
+    )
+    warmup.start()
     
     try:
         if not prompt and fprompt:
@@ -130,8 +188,9 @@ def main():
     memory.declareEvent("Speaking")
     memory.declareEvent("EyeContact")
     memory.declareEvent("ResetConversation")
-
-    speech_recoginition_url = os.getenv('SPEECH_RECOGINITION_URL') or server_url
+    memory.declareEvent("SpeculativeRecognition")
+    memory.declareEvent("SpeculationConfirmed")
+    memory.declareEvent("SpeculationCancelled")
 
     global SpeechRecognition
     SpeechRecognition = SpeechRecognitionModule(
@@ -140,26 +199,123 @@ def main():
     )
 
     global EyeContact
-    EyeContact = EyeContactModule("EyeContact")
+    EyeContact = EyeContactModule(
+        "EyeContact",
+        face_found_delay=tofloat(os.getenv('FACE_FOUND_DELAY')),
+        face_lost_delay=tofloat(os.getenv('FACE_LOST_DELAY', 1.0))
+    )
 
     # auto-detection
+    SpeechRecognition.setCaptureProfile(os.getenv('CAPTURE_PROFILE') or 'all-48k')
     SpeechRecognition.setHoldTime(tofloat(os.getenv('HOLD_TIME')) or 2.0)
     SpeechRecognition.setIdleReleaseTime(tofloat(os.getenv('RELEASE_TIME')) or 1.0)
+    SpeechRecognition.setSpeakingReleaseTime(tofloat(os.getenv('SPEAKING_RELEASE_TIME', 0.3)))
+    SpeechRecognition.setSpeculativeReleaseTime(tofloat(os.getenv('SPECULATIVE_RELEASE_TIME')))
     SpeechRecognition.setMaxRecordingDuration(tofloat(os.getenv('RECORD_DURATION')) or 7.0)
     SpeechRecognition.setLookaheadDuration(tofloat(os.getenv('LOOK_AHEAD_DURATION')) or 0.5)
     SpeechRecognition.setAutoDetectionThreshold(toint(os.getenv('AUTO_DETECTION_THREADSHOLD')) or 5)
+    SpeechRecognition.setCalibrationDuration(tofloat(os.getenv('CALIBRATION_DURATION')) or 4.0)
+    SpeechRecognition.setAdaptiveThresholdFactors(
+        tofloat(os.getenv('CALIBRATION_THRESHOLD_FACTOR')) or 1.5,
+        tofloat(os.getenv('CALIBRATION_STOP_FACTOR')) or 1.2
+    )
+    if toint(os.getenv('ADAPTIVE_THRESHOLD')):
+        SpeechRecognition.enableAdaptiveThreshold()
+    SpeechRecognition.setRecognitionQueue(
+        toint(os.getenv('RECOGNITION_WORKERS')) or 2,
+        toint(os.getenv('RECOGNITION_QUEUE_SIZE')) or 4,
+        os.getenv('RECOGNITION_QUEUE_POLICY') or 'coalesce'
+    )
+    SpeechRecognition.setRecognitionRetries(
+        tofloat(os.getenv('STT_DEADLINE')) or 10.0,
+        toint(os.getenv('STT_RETRIES', 2)),
+        tofloat(os.getenv('STT_RETRY_BACKOFF')) or 0.2
+    )
+    # hedging needs a second endpoint, a copy to the same slow server only adds to its load
+    if toint(os.getenv('STT_HEDGE', int(len(SpeechRecognition.recognizer.endpoints) > 1))):
+        SpeechRecognition.enableHedging(tofloat(os.getenv('STT_HEDGE_DELAY')) or 1.0)
+    else:
+        SpeechRecognition.disableHedging()
     SpeechRecognition.enableAutoDetection()
+    if toint(os.getenv('STREAM_RECOGNITION')):
+        SpeechRecognition.enableStreamingRecognition()
     SpeechRecognition.start()
 
+    # answers similar questions from the FAQ file and/or previous answers
+    similarity_index = None
+    similarity_learn = bool(toint(os.getenv('SIMILARITY_LEARN')))
+    if faq or similarity_learn:
+        similarity_index = SimilarityIndex(tofloat(os.getenv('SIMILARITY_THRESHOLD')) or 0.8)
+        if faq:
+            try:
+                similarity_index.load_faq(faq)
+                print('INF: Loaded %d FAQ questions' % len(similarity_index))
+            except:
+                print('\n\nLoading FAQ failed, is the file exists and valid json? Process without FAQ...\n\n')
+
+    # conversation log, DIALOGUE_LOG alone enables it too
+    dialogue_log = None
+    dialogue_log_path = os.getenv('DIALOGUE_LOG')
+    if save_csv or dialogue_log_path:
+        dialogue_log = DialogueLog(
+            dialogue_log_path or 'dialogue.csv',
+            flush_interval=tofloat(os.getenv('DIALOGUE_LOG_FLUSH_INTERVAL')) or 1.0,
+            max_bytes=toint(os.getenv('DIALOGUE_LOG_MAX_BYTES')) or 10 << 20,
+            max_age=tofloat(os.getenv('DIALOGUE_LOG_MAX_AGE')),
+            backups=toint(os.getenv('DIALOGUE_LOG_BACKUPS')) or 5
+        )
+
     global Receiver
     Receiver = BaseSpeechReceiverModule(
         "Receiver", ip, port,
         server_url=server_url, base_route=chat_route,
-        api_key=api_key, model_name=model_name, save_csv=save_csv,
-        system_prompt=prompt
+        api_key=api_key, model_name=model_name, dialogue_log=dialogue_log,
+        system_prompt=prompt, stream=stream,
+        history_max_tokens=toint(os.getenv('HISTORY_MAX_TOKENS')) or 2048,
+        history_max_chars=toint(os.getenv('HISTORY_MAX_CHARS')),
+        history_idle_reset=tofloat(os.getenv('HISTORY_IDLE_RESET')),
+        history_summary=bool(toint(os.getenv('HISTORY_SUMMARY'))),
+        cache_size=toint(os.getenv('RESPONSE_CACHE_SIZE')),
+        cache_ttl=tofloat(os.getenv('RESPONSE_CACHE_TTL')) or 3600,
+        cache_context=toint(os.getenv('RESPONSE_CACHE_CONTEXT')),
+        cache_file=os.getenv('RESPONSE_CACHE_FILE'),
+        similarity_index=similarity_index, similarity_learn=similarity_learn,
+        turn_policy=os.getenv('TURN_POLICY') or 'queue',
+        turn_queue_size=toint(os.getenv('TURN_QUEUE_SIZE')) or 2,
+        turn_deadline=tofloat(os.getenv('TURN_DEADLINE', 15)),
+        filler_delay=tofloat(os.getenv('FILLER_DELAY', 2.5)),
+        fillers=(os.getenv('FILLERS') or 'Let me think.|Hmm, one moment.|Good question, let me see.').split('|'),
+        fallback_reply=os.getenv('FALLBACK_REPLY', "Sorry, I can't answer that right now. Please ask me again in a moment."),
+        breaker_failures=toint(os.getenv('BREAKER_FAILURES', 3)),
+        breaker_probe_interval=tofloat(os.getenv('BREAKER_PROBE_INTERVAL')) or 10.0
     )
     Receiver.start()
 
+    # latency metrics, prometheus text format on http://<robot>:<port>/metrics and/or json lines dumped to a file
+    metrics_port = toint(os.getenv('METRICS_PORT'))
+    if metrics_port:
+        metrics.serve(metrics_port)
+    metrics_file = os.getenv('METRICS_FILE')
+    if metrics_file:
+        metrics.start_dump(metrics_file, tofloat(os.getenv('METRICS_INTERVAL')) or 60)
+
+    # the system prompt is processed by the server before the first question, WARMUP_PRIME=0 disables it
+    modules_started = time.time() - startup
+    metrics.register_gauges('warmup', warmup.stats)
+    warmup.ready(Receiver.prime if toint(os.getenv('WARMUP_PRIME', 1)) else None)
+    print('INF: Started in %.2fs (modules %.2fs), you can speek now' % (time.time() - startup, modules_started))
+
+    if opts.replay:
+        replayer = replay.Replay(SpeechRecognition, speed=opts.replay_speed, stub=stub)
+        report = replayer.run(replay.load_directory(opts.replay))
+        SpeechRecognition.stop()
+        Receiver.stop()
+        http_pool.clear()
+        if stub:
+            stub.stop()
+        replay.print_report(report, metrics.summary())
+        return
+
     if webview:
         tablet_service = ALProxy("ALTabletService")
         tablet_service.loadUrl(webview)
@@ -0,0 +1,197 @@
+import collections
+import json
+import multiprocessing
+import random
+import socket
+import sys
+import threading
+import time
+import BaseHTTPServer
+import SocketServer
+
+# latency profiles of the stub services, seconds:
+# speech recognition and chat completion first byte are (latency, jitter, error rate),
+# token is (latency, jitter) between streamed words, jitter is the standard deviation
+PROFILES = {
+    'none': {'stt': (0, 0, 0), 'llm': (0, 0, 0), 'token': (0, 0)},
+    'local': {'stt': (0.08, 0.02, 0), 'llm': (0.2, 0.05, 0), 'token': (0.01, 0.003)},
+    'cloud': {'stt': (0.35, 0.1, 0.01), 'llm': (0.7, 0.25, 0.01), 'token': (0.025, 0.01)},
+    'flaky': {'stt': (0.5, 0.4, 0.1), 'llm': (1.2, 0.8, 0.1), 'token': (0.05, 0.04)},
+}
+
+
+class ServiceHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Keep-alive request handler with helpers to read (chunked) bodies and send json or chunked responses"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            body = []
+            size = int(self.rfile.readline().split(';')[0], 16)
+            while size:
+                body.append(self.rfile.read(size))
+                self.rfile.readline()
+                size = int(self.rfile.readline().split(';')[0], 16)
+            self.rfile.readline()
+            return ''.join(body)
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def send_event(self, data):
+        self.send_chunk('data: ' + json.dumps(data) + '\n\n')
+
+    def send_chunk(self, data):
+        self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubHandler(ServiceHandler):
+    """Answers speech recognition and chat completion requests like the real services, without any model"""
+
+    def do_POST(self):
+        body = self.read_body()
+        route = self.path.split('?')[0]
+
+        if self.server.batch_route and route.endswith(self.server.batch_route):
+            # several recordings in one request, recognized in the time of one
+            files = json.loads(body)['files']
+            if self.server.wait('stt'):
+                self.send_json({'results': [{'text': self.server.next_transcript()} for _ in files]})
+            else:
+                self.send_json({'error': 'Speech recognition failed'}, 500)
+        elif route.endswith(self.server.speech_route):
+            if self.server.wait('stt'):
+                self.send_json({'text': self.server.next_transcript()})
+            else:
+                self.send_json({'error': 'Speech recognition failed'}, 500)
+        elif route.endswith(self.server.chat_route):
+            request = json.loads(body)
+            if self.server.wait('llm'):
+                self.chat(request)
+            else:
+                self.send_json({'error': 'Chat completion failed'}, 500)
+        else:
+            self.send_json({'error': 'Not found'}, 404)
+
+    def chat(self, request):
+        question = ([m['content'] for m in request['messages'] if m['role'] == 'user'] or [''])[-1]
+        answer = self.server.answer(question)
+        words = answer.split(' ')
+
+        if not request.get('stream'):
+            time.sleep(sum(self.server.delay('token') for _ in words))
+            self.send_json({'choices': [{'message': {'role': 'assistant', 'content': answer}}]})
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.server.delay('token'))
+            self.send_event({'choices': [{'delta': {'content': (' ' if i else '') + word}}]})
+        self.send_chunk('data: [DONE]\n\n')
+        self.send_chunk('')
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local stand-in for the speech recognition and chat completion services.
+    Speech recognition returns queued transcripts in order (or default_transcript),
+    chat completion repeats the question. With batch_route, {"files": [base64 wav, ...]} posted there
+    is answered with {"results": [{"text": ...}, ...]} after the latency of a single recognition.
+    Responses are delayed and fail according to profile, a name of PROFILES or a dict like them.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, speech_route='/speech/recognition', chat_route='/chat/completions',
+                 default_transcript='hello', profile='none', seed=None, batch_route=None):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), StubHandler)
+        self.speech_route = speech_route
+        self.chat_route = chat_route
+        self.batch_route = batch_route
+        self.default_transcript = default_transcript
+        self.transcripts = collections.deque()
+        self.lock = threading.Lock()
+
+        self.profile = PROFILES[profile] if isinstance(profile, basestring) else profile
+        self.random = random.Random(seed)
+        self.requests = collections.defaultdict(int)
+        self.errors = collections.defaultdict(int)
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def queue_transcript(self, text):
+        with self.lock:
+            self.transcripts.append(text)
+
+    def next_transcript(self):
+        with self.lock:
+            return self.transcripts.popleft() if self.transcripts else self.default_transcript
+
+    def handle_error(self, request, client_address):
+        # clients cancel requests by closing the connection
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def delay(self, service):
+        latency, jitter = self.profile[service][:2]
+        with self.lock:
+            return max(0.0, self.random.gauss(latency, jitter)) if jitter else latency
+
+    def wait(self, service):
+        """Sleeps for the latency of service, returns False if the request should fail"""
+        with self.lock:
+            self.requests[service] += 1
+            failed = self.random.random() < self.profile[service][2]
+            if failed:
+                self.errors[service] += 1
+
+        time.sleep(self.delay(service))
+        return not failed
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'errors': dict(self.errors)}
+
+    def answer(self, question):
+        return 'You said: %s. That is all I know.' % question
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='StubServer')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def serve(urls, kwargs):
+    server = StubServer(**kwargs)
+    urls.put(server.url)
+    server.serve_forever()
+
+def start_process(**kwargs):
+    """Runs a StubServer in a child process, so it doesn't use cpu time of the caller. Returns (process, url)"""
+    urls = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(urls, kwargs), name='StubServer')
+    process.daemon = True
+    process.start()
+    return process, urls.get(timeout=10)
@@ -1,10 +1,18 @@
 import os
-import urllib2
+import httplib
+import urlparse
+import socket
+import threading
+import time
 import json
-import io
-import wave
+import Queue
+import re
 import struct
 
+import numpy as np
+
+from audio import Resampler
+
 def load_env(file_path = '.env'):
     try:
         with open(file_path, 'r') as f:
@@ -36,42 +44,390 @@ def tofloat(float_like):
     except:
         return 0
     
-def request(base_url, route, body, headers = {}, is_json = True):
+class RequestCancelled(socket.error):
+    pass
+
+class StreamInterrupted(Exception):
+    pass
+
+
+class Cancellable(object):
+    """
+    Lets another thread abort a request: the socket is shut down, which wakes up the thread waiting for the response,
+    and the request fails with a socket error. The connection is closed instead of going back to the pool.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def attach(self, conn):
+        with self.lock:
+            if self.cancelled:
+                raise RequestCancelled('Request cancelled')
+            self.conn = conn
+
+    def detach(self, conn):
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            # shut down while holding the lock, so the connection can't be released to the pool meanwhile
+            if self.conn is not None and self.conn.sock:
+                try:
+                    self.conn.sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+
+class Debounce(object):
+    """
+    A boolean state following a flapping signal: set() changes it to True only after the signal stayed True
+    for on_delay seconds, to False after off_delay seconds, callback(state) is called on each change.
+    A change back within the delay is ignored, so quick flips never reach the callback.
+    """
+
+    def __init__(self, callback, on_delay=0, off_delay=0, state=False):
+        self.callback = callback
+        self.on_delay = on_delay
+        self.off_delay = off_delay
+        self.state = state
+        self.timer = None
+        self.lock = threading.Lock()
+
+        self.changes = 0
+        self.ignored = 0
+
+    def set(self, value):
+        value = bool(value)
+        with self.lock:
+            if self.timer and self.timer.value != value:
+                # flipped back before the delay was over
+                self.timer.cancel()
+                self.timer = None
+                self.ignored += 1
+            if value == self.state or self.timer:
+                return
+
+            delay = self.on_delay if value else self.off_delay
+            if delay > 0:
+                self.timer = threading.Timer(delay, self.apply, [value])
+                self.timer.value = value
+                self.timer.daemon = True
+                self.timer.start()
+                return
+            self.state = value
+            self.changes += 1
+
+        self.callback(value)
+
+    def apply(self, value):
+        with self.lock:
+            # runs on the timer thread, unless it was cancelled meanwhile
+            if self.timer is not threading.current_thread():
+                return
+            self.timer = None
+            self.state = value
+            self.changes += 1
+
+        self.callback(value)
+
+    def stats(self):
+        return {'state': int(self.state), 'changes': self.changes, 'ignored': self.ignored}
+
+
+class PooledResponse(object):
+    """Wraps a httplib response, the connection goes back to the pool once the body is fully read"""
+
+    def __init__(self, pool, key, conn, response, cancel=None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.cancel = cancel
+        self.status = response.status
+        self.reason = response.reason
+
+    def read(self):
+        try:
+            return self.response.read()
+        finally:
+            self.close()
+
+    def iter_chunks(self):
+        """Yields the body as it arrives, httplib itself only reads chunked bodies in fixed sizes which blocks streaming"""
+        try:
+            fp = self.response.fp
+            if self.response.chunked:
+                while True:
+                    line = fp.readline()
+                    if not line:
+                        raise httplib.IncompleteRead('')
+                    size = int(line.split(';')[0], 16)
+                    if size == 0:
+                        # skip trailers
+                        line = fp.readline()
+                        while line and line != '\r\n':
+                            line = fp.readline()
+                        break
+                    data = fp.read(size)
+                    fp.read(2)  # CRLF after each chunk
+                    yield data
+                # the whole body is consumed, mark response as done so the connection can be reused
+                self.response.close()
+            elif self.response.length is None:
+                # body ends when server closes the connection
+                line = fp.readline()
+                while line:
+                    yield line
+                    line = fp.readline()
+            else:
+                yield self.response.read()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.conn is None:
+            return
+
+        if self.cancel:
+            self.cancel.detach(self.conn)
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.conn.close()
+        self.conn = None
+
+
+class HTTPConnectionPool(object):
+    """
+    Keeps keep-alive connections open for each host, so requests don't pay for a new TCP (and TLS) handshake every time.
+    At most max_size idle connections are kept for each host, extra connections are closed once released.
+    """
+
+    def __init__(self, max_size=4, idle_timeout=60.0, connect_timeout=5.0, read_timeout=60.0):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.idle = {}  # (scheme, host) -> list of (connection, released timestamp)
+        self.lock = threading.Lock()
+        self.last_used = 0  # timestamp of the last request
+
+    def configure(self, max_size=None, idle_timeout=None, connect_timeout=None, read_timeout=None):
+        if max_size: self.max_size = max_size
+        if idle_timeout: self.idle_timeout = idle_timeout
+        if connect_timeout: self.connect_timeout = connect_timeout
+        if read_timeout: self.read_timeout = read_timeout
+
+    def connect(self, key, read_timeout=None):
+        scheme, host = key
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=self.connect_timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(read_timeout or self.read_timeout)
+        return conn
+
+    def acquire(self, key, read_timeout=None):
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(key) or []
+            while idle:
+                conn, released = idle.pop()
+                if now - released < self.idle_timeout and conn.sock:
+                    conn.sock.settimeout(read_timeout or self.read_timeout)
+                    return conn, True
+                conn.close()
+
+        return self.connect(key, read_timeout), False
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def preconnect(self, url, count=1):
+        """Opens idle connections to the host of url ahead of the first request, up to count of them"""
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        now = time.time()
+        with self.lock:
+            # connections idle for longer than idle_timeout would be closed instead of used, they don't count
+            idle = self.idle.get(key) or []
+            fresh = [(conn, released) for conn, released in idle if now - released < self.idle_timeout and conn.sock]
+            stale = [conn for conn, released in idle if (conn, released) not in fresh]
+            self.idle[key] = fresh
+        for conn in stale:
+            conn.close()
+        for _ in range(min(count, self.max_size) - len(fresh)):
+            self.release(key, self.connect(key))
+
+    def clear(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, _ in idle:
+                    conn.close()
+            self.idle = {}
+
+    def urlopen(self, method, url, body=None, headers={}, read_timeout=None, cancel=None):
+        parsed = urlparse.urlsplit(url)
+        key = (parsed.scheme, parsed.netloc)
+        path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+
+        self.last_used = time.time()
+        conn, reused = self.acquire(key, read_timeout)
+        try:
+            if cancel:
+                cancel.attach(conn)
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except socket.timeout:
+            self.discard(conn, cancel)
+            raise
+        except (socket.error, httplib.HTTPException):
+            self.discard(conn, cancel)
+            if not reused or (cancel and cancel.cancelled):
+                raise
+            # idle connection was closed by the server in the meantime, retry once with a new one
+            conn = self.connect(key, read_timeout)
+            try:
+                if cancel:
+                    cancel.attach(conn)
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except:
+                self.discard(conn, cancel)
+                raise
+
+        return PooledResponse(self, key, conn, response, cancel)
+
+    def discard(self, conn, cancel=None):
+        if cancel:
+            cancel.detach(conn)
+        conn.close()
+
+# shared by all requests to services, configure with http_pool.configure()
+http_pool = HTTPConnectionPool()
+
+def make_request(base_url, route, body, headers = {}, is_json = True):
     if is_json:
         body = json.dumps(body)
-    
-    req = urllib2.Request(base_url+route, data=body)
-    
-    if 'Content-Type' not in headers:
-        req.add_header('Content-Type', 'application/json')
 
-    for k, v in headers.items():
-        req.add_header(k, v)
+    req_headers = {'Content-Type': 'application/json'}
+    req_headers.update(headers)
+
+    return base_url+route, body, req_headers
+
+def request(base_url, route, body, headers = {}, is_json = True, timeout = None, cancel = None):
+    url, body, headers = make_request(base_url, route, body, headers, is_json)
 
     try:
-        response = urllib2.urlopen(req)
+        response = http_pool.urlopen('POST', url, body, headers, timeout, cancel)
         response_data = response.read()
+        if response.status >= 400:
+            print("HTTP Error:", response.status, response_data)
+            return
         return json.loads(response_data)
-    
-    except urllib2.HTTPError as e:
-        print("HTTP Error:", e.code, e.read())
 
-    except urllib2.URLError as e:
-        print("URL Error:", e.reason)
+    except (socket.error, httplib.HTTPException) as e:
+        # a cancelled request is expected to fail, the response is discarded
+        if not (cancel and cancel.cancelled):
+            print("URL Error:", e)
+
+def stream_request(base_url, route, body, headers = {}, timeout = None, cancel = None):
+    """
+    Sends a json request and yields the parsed data of each server-sent event as it arrives.
+    Raises StreamInterrupted when the stream ends before the server sent [DONE], e.g. after an error or a cancel
+    """
+    url, body, headers = make_request(base_url, route, body, headers)
+    headers['Accept'] = 'text/event-stream'
+    done = False
 
+    try:
+        response = http_pool.urlopen('POST', url, body, headers, timeout, cancel)
+        if response.status >= 400:
+            print("HTTP Error:", response.status, response.read())
+            raise StreamInterrupted('HTTP %d' % response.status)
 
-def chat_completion(base_url, messages, max_tokens=0, route='/chat/completions', model_name=None, api_key=None):
+        pending = ''
+        for chunk in response.iter_chunks():
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                line = line.strip()
+                # ignore comments, event names and keep-alive blank lines
+                if line.startswith('data:'):
+                    data = line[5:].strip()
+                    if data == '[DONE]':
+                        done = True
+                        continue
+                    yield json.loads(data)
+
+    except (socket.error, httplib.HTTPException) as e:
+        if not (cancel and cancel.cancelled):
+            print("URL Error:", e)
+
+    if not done:
+        raise StreamInterrupted('Stream ended before [DONE]')
+
+
+def chat_completion(base_url, messages, max_tokens=0, route='/chat/completions', model_name=None, api_key=None, timeout=None, cancel=None):
     data = {
         'messages': messages,
     }
     if model_name: data['model'] = model_name
     if max_tokens: data['max_tokens'] = max_tokens
 
-    resp = request(base_url, route, data, {'Authorization': 'Bearer '+ (api_key or 'no-key')})
+    resp = request(base_url, route, data, {'Authorization': 'Bearer '+ (api_key or 'no-key')}, timeout=timeout, cancel=cancel)
     resp_text = str(resp['choices'][0]['message']['content']) if resp else ''
    
     return resp_text
 
+def chat_completion_stream(base_url, messages, max_tokens=0, route='/chat/completions', model_name=None, api_key=None, timeout=None, cancel=None):
+    """Same as chat_completion but with stream enabled, yields pieces of the response text as they are generated"""
+    data = {
+        'messages': messages,
+        'stream': True
+    }
+    if model_name: data['model'] = model_name
+    if max_tokens: data['max_tokens'] = max_tokens
+
+    for chunk in stream_request(base_url, route, data, {'Authorization': 'Bearer '+ (api_key or 'no-key')}, timeout=timeout, cancel=cancel):
+        choices = chunk.get('choices') or [{}]
+        content = (choices[0].get('delta') or {}).get('content')
+        if content:
+            yield content
+
+# a sentence is only complete when the punctuation is followed by a whitespace, otherwise it can be something like 3.14
+SENTENCE_END = re.compile(u'[.!?]+[\'")\\]]*\\s+|[\u3002\uff01\uff1f]+|\\n+', re.UNICODE)
+
+def split_sentences(pieces):
+    """Joins streamed pieces of text and yields each sentence as soon as it's complete"""
+    pending = ''
+    for piece in pieces:
+        pending += piece
+        start = 0
+        for match in SENTENCE_END.finditer(pending):
+            sentence = pending[start:match.end()].strip()
+            if sentence:
+                yield sentence
+            start = match.end()
+        pending = pending[start:]
+
+    pending = pending.strip()
+    if pending:
+        yield pending
+
 def audio_recoginze(base_url, data, route='/speech/recognition', api_key='no-key'):
     resp = request(
         base_url, route, data, is_json=False,
@@ -80,6 +436,9 @@ def audio_recoginze(base_url, data, route='/speech/recognition', api_key='no-key
             'Authorization': 'Bearer '+ (api_key or 'no-key')
         }
     )
+    return recognition_text(resp)
+
+def recognition_text(resp):
     recoginzed_text = ''
 
     if resp:
@@ -90,37 +449,178 @@ def audio_recoginze(base_url, data, route='/speech/recognition', api_key='no-key
     
     return recoginzed_text
 
+TRANSCRIPT_PUNCTUATION = re.compile(r"[^\w']+", re.UNICODE)
+
+def merge_transcripts(left, right, max_words=8):
+    """Joins transcripts of overlapping audio segments, words at the end of left repeated at the start of right are kept once"""
+    left_words, right_words = left.split(), right.split()
+    key = lambda word: TRANSCRIPT_PUNCTUATION.sub('', word.lower())
+    for n in range(min(max_words, len(left_words), len(right_words)), 0, -1):
+        if [key(w) for w in left_words[-n:]] == [key(w) for w in right_words[:n]]:
+            right_words = right_words[n:]
+            break
+    return ' '.join(left_words + right_words)
+
+class AudioUpload(object):
+    """
+    Uploads audio to speech recognition with chunked transfer encoding while it's still being recorded.
+    The WAV header is sent first with maximum sizes as the length is unknown, samples are sent as they're queued.
+    Network I/O runs on its own thread, send() and finish() never block.
+    Cancelling shuts the connection down, so it also aborts an upload waiting for its response.
+    """
+
+    def __init__(self, base_url, route='/speech/recognition', api_key='no-key', sample_rate=48000, upload_rate=48000):
+        self.url = base_url + route
+        self.api_key = api_key
+        self.upload_rate = upload_rate
+        self.resampler = Resampler(sample_rate, upload_rate) if sample_rate != upload_rate else None
+
+        self.samples = Queue.Queue()
+        self.request = Cancellable()
+        self.cancelled = False
+        self.expired = False
+        self.result = None
+        self.done = threading.Event()
+
+        thread = threading.Thread(target=self.run, name='AudioUpload')
+        thread.daemon = True
+        thread.start()
+
+    def send(self, samples):
+        self.samples.put(samples)
+
+    def finish(self):
+        self.samples.put(None)
+
+    def cancel(self):
+        self.cancelled = True
+        self.samples.put(None)
+        self.request.cancel()
+
+    def wait(self, timeout=None):
+        """Returns the recognized text, or None if the upload failed, was cancelled or took longer than timeout seconds"""
+        # a timer cancels the upload, on python 2 waiting with a timeout polls
+        timer = threading.Timer(timeout, self.expire) if timeout is not None else None
+        if timer:
+            timer.start()
+        self.done.wait()
+        if timer:
+            timer.cancel()
+        return self.result
+
+    def expire(self):
+        self.expired = True
+        self.cancel()
+        self.done.set()
+
+    def write_chunk(self, conn, data):
+        # one send per chunk, small separate writes get delayed by nagle's algorithm
+        chunk = bytearray('%x\r\n' % len(data))
+        chunk += data
+        chunk += '\r\n'
+        conn.send(chunk)
+
+    def run(self):
+        parsed = urlparse.urlsplit(self.url)
+        key = (parsed.scheme, parsed.netloc)
+        conn = None
+
+        try:
+            conn = http_pool.connect(key)
+            self.request.attach(conn)
+            conn.putrequest('POST', parsed.path or '/', skip_accept_encoding=True)
+            conn.putheader('Content-Type', 'audio/wav')
+            conn.putheader('Authorization', 'Bearer '+ (self.api_key or 'no-key'))
+            conn.putheader('Transfer-Encoding', 'chunked')
+            conn.endheaders()
+
+            header = bytearray(WAV_HEADER_SIZE)
+            write_wav_header(header, self.upload_rate, 1, 2, None)
+            self.write_chunk(conn, header)
+
+            samples = self.samples.get()
+            while samples is not None:
+                if self.resampler:
+                    samples = self.resampler.process(samples)
+                if len(samples):
+                    self.write_chunk(conn, np.asarray(samples, dtype='<i2').tobytes())
+                samples = self.samples.get()
+
+            if self.cancelled:
+                return
+
+            conn.send('0\r\n\r\n')
+            response = PooledResponse(http_pool, key, conn, conn.getresponse(), self.request)
+            conn = None
+
+            response_data = response.read()
+            if response.status >= 400:
+                print("HTTP Error:", response.status, response_data)
+                return
+            self.result = recognition_text(json.loads(response_data))
+
+        except (socket.error, httplib.HTTPException) as e:
+            # a cancelled upload is expected to fail
+            if not self.cancelled:
+                print("URL Error:", e)
+
+        finally:
+            if conn:
+                http_pool.discard(conn, self.request)
+            self.done.set()
+
+WAV_HEADER_SIZE = 44
+
+# sample width in bytes -> signed little endian dtype the samples are stored as
+WAV_SAMPLE_DTYPES = {1: '<i1', 2: '<i2', 3: '<i4', 4: '<i4'}
+
 def buffer_to_wav_in_memory(buffer, sample_rate=48000, num_channels=1, sampwidth=2):
-    # Ensure that the buffer length matches the expected size for the sample width
-    if sampwidth == 2:
-        # Expect buffer to be a list of 16-bit PCM samples (signed integers)
-        expected_len = len(buffer)
-        if expected_len % num_channels != 0:
-            raise ValueError("Buffer length is not divisible by the number of channels")
-        
-        # Convert the buffer into the proper format
-        # '<h' means little-endian ('<') 16-bit signed integers ('h')
-        buffer_bytes = struct.pack('<' + 'h' * expected_len, *buffer)
-    else:
+    """
+    Encodes PCM samples to a WAV file in memory, returns a bytearray.
+    buffer is either an array (or list) of interleaved samples, or a 2d array shaped (channels, samples).
+    Samples are signed integers in the range of the sample width, 8 bits samples are converted to unsigned as WAV requires.
+    """
+    if sampwidth not in WAV_SAMPLE_DTYPES:
         raise ValueError("Unsupported sample width")
 
-    # Create an in-memory buffer for the WAV file
-    byte_io = io.BytesIO()
+    data = np.asarray(buffer)
+    if data.ndim == 2:
+        num_channels = data.shape[0]
+        # interleave channels
+        data = data.T
+    elif len(data) % num_channels != 0:
+        raise ValueError("Buffer length is not divisible by the number of channels")
 
-    # Open the WAV file for writing (Python 2.7 does not support 'with' context for wave module)
-    wav_file = wave.open(byte_io, 'wb')
-    
-    # Set the number of channels, sample width, and frame rate
-    wav_file.setnchannels(num_channels)  # Mono = 1, Stereo = 2
-    wav_file.setsampwidth(sampwidth)     # Sample width in bytes (2 for 16-bit PCM)
-    wav_file.setframerate(sample_rate)   # Samples per second
+    # no copy when samples already have the right type, which is the case for int16 from the ring buffer
+    data = np.ascontiguousarray(data, dtype=WAV_SAMPLE_DTYPES[sampwidth]).reshape(-1)
 
-    # Write the PCM data to the in-memory file
-    wav_file.writeframes(buffer_bytes)
-    
-    # Close the WAV file manually
-    wav_file.close()
+    if sampwidth == 1:
+        data = (data.astype('<i2') + 128).astype('u1')
+    elif sampwidth == 3:
+        # keep the lower 3 bytes of each little endian int32
+        data = data.view('u1').reshape(-1, 4)[:, :3]
+
+    data_size = data.size * data.itemsize
 
-    # Get the WAV file as a byte string
-    byte_io.seek(0)
-    return byte_io.read()
\ No newline at end of file
+    wav = bytearray(WAV_HEADER_SIZE + data_size)
+    write_wav_header(wav, sample_rate, num_channels, sampwidth, data_size)
+
+    # copy samples right after the header, no per sample python objects involved
+    np.frombuffer(wav, dtype=data.dtype, offset=WAV_HEADER_SIZE).reshape(data.shape)[...] = data
+    return wav
+
+def write_wav_header(wav, sample_rate, num_channels, sampwidth, data_size):
+    # data_size of None writes the maximum sizes, for streaming audio whose length is unknown yet
+    if data_size is None:
+        riff_size = data_size = 0xFFFFFFFF
+    else:
+        riff_size = WAV_HEADER_SIZE - 8 + data_size
+
+    block_align = num_channels * sampwidth
+
+    struct.pack_into(
+        '<4sI4s4sIHHIIHH4sI', wav, 0,
+        b'RIFF', riff_size, b'WAVE',
+        b'fmt ', 16, 1, num_channels, sample_rate, sample_rate * block_align, block_align, sampwidth * 8,
+        b'data', data_size
+    )
@@ -0,0 +1,106 @@
+import socket
+import threading
+import time
+import traceback
+import urlparse
+
+from tools import http_pool
+
+
+class Warmup(object):
+    """
+    Gets the services ready before anybody talks to the robot: resolves their host names,
+    opens keep-alive connections in http_pool and sends a priming request, so the first answer
+    doesn't pay for cold DNS, TCP/TLS setup and prompt processing on the server.
+    start() resolves and connects in the background while the modules start, ready() primes and returns the
+    seconds each phase took. Afterwards everything is done again when the services were idle for
+    idle_timeout seconds, as connections are closed and the server's cache evicted by then. 0 disables it.
+    """
+
+    PHASES = ('dns', 'connect', 'prime')
+
+    def __init__(self, urls, connections=1, idle_timeout=0):
+        self.urls = list(set(url for url in urls if url))
+        self.connections = connections
+        self.idle_timeout = idle_timeout
+        self.prime = None
+
+        self.timings = {}
+        self.runs = 0
+        self.errors = 0
+        self.last_run = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.network, name='Warmup')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def ready(self, prime=None):
+        """Waits for the network phases, then primes with prime() when given. Returns the timings"""
+        self.prime = prime
+        start = time.time()
+        self.thread.join()
+        self.timings['network_wait'] = time.time() - start
+        self.phase('prime', self.priming)
+        self.finish()
+
+        if self.idle_timeout:
+            thread = threading.Thread(target=self.watch, name='Warmup-idle')
+            thread.daemon = True
+            thread.start()
+        return dict(self.timings)
+
+    def run(self):
+        """Warms up again, e.g. after a long idle time"""
+        with self.lock:
+            self.timings = {}
+            self.network()
+            self.phase('prime', self.priming)
+            self.finish()
+
+    def network(self):
+        self.phase('dns', self.resolve)
+        self.phase('connect', self.connect)
+
+    def phase(self, name, fn):
+        start = time.time()
+        try:
+            fn()
+        except:
+            # a service being down at startup shouldn't keep the robot from starting, requests retry anyway
+            self.errors += 1
+            traceback.print_exc()
+        self.timings[name] = time.time() - start
+
+    def resolve(self):
+        for url in self.urls:
+            parsed = urlparse.urlsplit(url)
+            port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+            socket.getaddrinfo(parsed.hostname, port, 0, socket.SOCK_STREAM)
+
+    def connect(self):
+        for url in self.urls:
+            http_pool.preconnect(url, self.connections)
+
+    def priming(self):
+        if self.prime:
+            self.prime()
+
+    def finish(self):
+        self.runs += 1
+        self.last_run = time.time()
+        print('INF: Warm-up: %s' % ', '.join('%s %.3fs' % (name, self.timings[name]) for name in self.PHASES))
+
+    def watch(self):
+        while True:
+            time.sleep(min(self.idle_timeout / 4.0, 60))
+            idle_since = max(http_pool.last_used, self.last_run)
+            if time.time() - idle_since >= self.idle_timeout:
+                self.run()
+
+    def stats(self):
+        stats = dict((name + '_seconds', value) for name, value in self.timings.items())
+        stats.update({'runs': self.runs, 'errors': self.errors})
+        return stats
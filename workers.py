@@ -0,0 +1,283 @@
+import collections
+import threading
+import time
+import traceback
+
+# marks a job that was dropped from the queue, its result is never handed to the callback
+DROPPED = object()
+
+
+class OrderedWorkerPool(object):
+    """
+    Fixed number of worker threads consuming a bounded job queue.
+    Results are handed to callback in the same order jobs were submitted, no matter which worker finishes first.
+    When the queue is full, policy decides what happens to the new job:
+    'drop-newest' discards it, 'drop-oldest' discards the oldest queued job,
+    'coalesce' merges it into the newest queued job with coalesce(queued, new),
+    when that returns None the jobs can't be merged and the oldest queued job is discarded instead.
+    """
+
+    POLICIES = ('drop-newest', 'drop-oldest', 'coalesce')
+
+    def __init__(self, handler, callback, workers=2, max_queue=4, policy='drop-oldest', coalesce=None, name='worker'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown queue policy: %s" % policy)
+        if policy == 'coalesce' and coalesce is None:
+            raise ValueError("coalesce function is required for the coalesce policy")
+
+        self.handler = handler
+        self.callback = callback
+        self.max_queue = max(max_queue, 1)
+        self.policy = policy
+        self.coalesce = coalesce
+
+        self.jobs = collections.deque()  # (sequence, job, submitted timestamp)
+        self.cond = threading.Condition()
+        self.running = True
+
+        # results waiting for earlier jobs to finish before they can be delivered
+        self.results = {}
+        self.next_sequence = 0
+        self.next_delivery = 0
+        self.deliver_lock = threading.Lock()
+
+        # counters
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_queue_depth = 0
+        self.wait_time_sum = 0.0
+        self.wait_time_max = 0.0
+
+        self.threads = []
+        for i in range(max(workers, 1)):
+            thread = threading.Thread(target=self.work, name='%s-%d' % (name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, job):
+        """Queues a job, returns False if the job got dropped"""
+        dropped = None
+
+        with self.cond:
+            if not self.running:
+                return False
+
+            self.submitted += 1
+
+            if len(self.jobs) >= self.max_queue:
+                if self.policy == 'drop-newest':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'coalesce':
+                    sequence, queued, timestamp = self.jobs[-1]
+                    merged = self.coalesce(queued, job)
+                    if merged is not None:
+                        self.jobs[-1] = (sequence, merged, timestamp)
+                        self.coalesced += 1
+                        return True
+
+                # drop-oldest, or coalesce when the jobs can't be merged
+                dropped = self.jobs.popleft()[0]
+                self.dropped += 1
+
+            self.jobs.append((self.next_sequence, job, time.time()))
+            self.next_sequence += 1
+            self.max_queue_depth = max(self.max_queue_depth, len(self.jobs))
+            self.cond.notify()
+
+        if dropped is not None:
+            self.finish(dropped, DROPPED)
+
+        return True
+
+    def work(self):
+        while True:
+            with self.cond:
+                while self.running and not self.jobs:
+                    self.cond.wait()
+                if not self.running:
+                    return
+
+                sequence, job, timestamp = self.jobs.popleft()
+
+                wait = time.time() - timestamp
+                self.wait_time_sum += wait
+                self.wait_time_max = max(self.wait_time_max, wait)
+
+            try:
+                result = self.handler(job)
+            except:
+                traceback.print_exc()
+                result = None
+
+            self.finish(sequence, result)
+
+    def finish(self, sequence, result):
+        with self.deliver_lock:
+            self.results[sequence] = result
+
+            # deliver every result that is next in order
+            while self.next_delivery in self.results:
+                result = self.results.pop(self.next_delivery)
+                self.next_delivery += 1
+
+                if result is DROPPED:
+                    continue
+
+                self.completed += 1
+                try:
+                    self.callback(result)
+                except:
+                    traceback.print_exc()
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            jobs = list(self.jobs)
+            self.jobs.clear()
+            self.cond.notify_all()
+
+        for sequence, _, _ in jobs:
+            self.finish(sequence, DROPPED)
+
+    def stats(self):
+        with self.cond:
+            started = self.submitted - self.dropped - self.coalesced - len(self.jobs)
+            return {
+                'queue_depth': len(self.jobs),
+                'max_queue_depth': self.max_queue_depth,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'pending': self.submitted - self.dropped - self.coalesced - self.completed,
+                'wait_time_avg': self.wait_time_sum / started if started > 0 else 0.0,
+                'wait_time_max': self.wait_time_max
+            }
+
+
+class TurnScheduler(object):
+    """
+    Runs jobs one at a time on a single thread, like turns of a conversation which can't overlap.
+    When a job is submitted while another one is running, policy decides what happens to it:
+    'queue' runs it afterwards (at most max_pending wait, the oldest are dropped),
+    'supersede' replaces the waiting jobs and cancels the running one with cancel(job),
+    'drop' discards it.
+    Jobs that never run are handed to discard(job, reason), reason being 'dropped' or 'superseded'.
+    """
+
+    POLICIES = ('queue', 'supersede', 'drop')
+
+    def __init__(self, handler, policy='queue', max_pending=2, cancel=None, discard=None, name='turns'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown turn policy: %s" % policy)
+
+        self.handler = handler
+        self.policy = policy
+        self.max_pending = max(max_pending, 1)
+        self.cancel = cancel
+        self.discard = discard
+
+        self.pending = collections.deque()
+        self.current = None
+        self.cond = threading.Condition()
+        self.running = True
+
+        # counters
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.superseded = 0
+        self.cancelled = 0
+
+        self.thread = threading.Thread(target=self.work, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, job):
+        discarded = []
+        cancelled = None
+
+        with self.cond:
+            if not self.running:
+                return False
+            self.submitted += 1
+
+            busy = self.current is not None or self.pending
+            if self.policy == 'drop' and busy:
+                discarded.append((job, 'dropped'))
+            elif self.policy == 'supersede':
+                discarded += [(queued, 'superseded') for queued in self.pending]
+                self.pending.clear()
+                self.pending.append(job)
+                cancelled = self.current
+            else:
+                self.pending.append(job)
+                while len(self.pending) > self.max_pending:
+                    discarded.append((self.pending.popleft(), 'dropped'))
+
+            for _, reason in discarded:
+                if reason == 'dropped':
+                    self.dropped += 1
+                else:
+                    self.superseded += 1
+            if cancelled is not None:
+                self.cancelled += 1
+            self.cond.notify()
+
+        # outside of the lock, these may take a while
+        if cancelled is not None and self.cancel:
+            self.cancel(cancelled)
+        if self.discard:
+            for discarded_job, reason in discarded:
+                self.discard(discarded_job, reason)
+
+        return not any(j is job for j, _ in discarded)
+
+    def work(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                self.current = self.pending.popleft()
+
+            try:
+                self.handler(self.current)
+            except:
+                traceback.print_exc()
+
+            with self.cond:
+                self.current = None
+                self.completed += 1
+
+    def stop(self):
+        """Stops after the running job, cancelling it, waiting jobs are discarded"""
+        with self.cond:
+            self.running = False
+            pending = list(self.pending)
+            self.pending.clear()
+            current = self.current
+            self.cond.notify_all()
+
+        if current is not None and self.cancel:
+            self.cancel(current)
+        if self.discard:
+            for job in pending:
+                self.discard(job, 'dropped')
+
+    def stats(self):
+        with self.cond:
+            return {
+                'pending': len(self.pending),
+                'busy': self.current is not None,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'dropped': self.dropped,
+                'superseded': self.superseded,
+                'cancelled': self.cancelled
+            }